@@ -1,32 +1,123 @@
-import sys
-
 import argparse
+import logging
+import multiprocessing
+import signal
+from threading import Event, Thread
+from typing import Callable
 
-from dns.server import DNSServer
-from threading import Thread
+from dns.cache import DNSCache, DEFAULT_CACHE_FILE
+from dns.local import LocalZones, DEFAULT_RELOAD_INTERVAL
+from dns.metrics import MetricsServer
+from dns.prefetch import (Prefetcher, DEFAULT_PREFETCH_FRACTION,
+                          DEFAULT_PREFETCH_HITS, DEFAULT_PREFETCH_RATE)
+from dns.server import DNSServer, DEFAULT_NEGATIVE_TTL
+from dns.shared_cache import SharedDNSCache
+from dns.upstream import DEFAULT_HEDGE_PERCENTILE, parse_address
 
 
-def _input_handler(dns_server: DNSServer):
+def _input_handler(stats: Callable[[], dict], stop: Callable[[], None]):
     while True:
         cmd = input().strip().lower()
+        if cmd == 'stats':
+            for key, value in stats().items():
+                print(f"{key}: {value}")
+            continue
+        if cmd.startswith('log '):
+            level = cmd.split(maxsplit=1)[1].upper()
+            try:
+                logging.getLogger('dns').setLevel(level)
+            except ValueError:
+                print(f"Unknown log level: {level}")
+            continue
         if cmd != 'quit':
             continue
         print("Quiting...")
-        dns_server.cache.save_cache()
-        sys.exit(0)
+        stop()
+        return
 
 
-def _main(args: argparse.Namespace):
-    server: DNSServer = DNSServer(
+def _make_server(args: argparse.Namespace, cache,
+                 reuse_port: bool = False) -> DNSServer:
+    return DNSServer(
         args.address,
         args.port,
-        '8.8.8.8')
+        [parse_address(upstream)
+         for upstream in args.upstream or ['8.8.8.8']],
+        timeout=args.timeout,
+        cache=cache,
+        negative_ttl=args.negative_ttl,
+        prefetcher=Prefetcher(fraction=args.prefetch_fraction,
+                              min_hits=args.prefetch_hits,
+                              rate=args.prefetch_rate),
+        hedge=args.hedge,
+        hedge_percentile=args.hedge_percentile,
+        log_sample=args.log_sample,
+        reuse_port=reuse_port,
+        local=LocalZones(args.zone, args.hosts, args.blocklist,
+                         reload_interval=args.reload_interval))
+
+
+def _run_worker(args: argparse.Namespace, cache: SharedDNSCache,
+                index: int):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = _make_server(args, cache, reuse_port=True)
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    if args.metrics_port:
+        MetricsServer(server.metrics, args.metrics_address,
+                      args.metrics_port + index).start()
+    server.run()
+
+
+def _run_workers(args: argparse.Namespace):
+    cache = SharedDNSCache(args.cache_size,
+                           args.cache_memory * 1024 * 1024,
+                           file=DEFAULT_CACHE_FILE)
+    # Workers inherit the shared block and its locks through fork
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_run_worker,
+                               args=(args, cache, index),
+                               daemon=True)
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    stopped = Event()
+    Thread(target=_input_handler,
+           args=(cache.stats, stopped.set),
+           daemon=True).start()
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.kill()
+        cache.save_cache()
+        cache.close()
+
+
+def _main(args: argparse.Namespace):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('dns').setLevel(args.log_level.upper())
+    if args.workers > 1:
+        _run_workers(args)
+        return
+    cache = DNSCache(max_entries=args.cache_size,
+                     max_bytes=args.cache_memory * 1024 * 1024)
+    server: DNSServer = _make_server(args, cache)
+    if args.metrics_port:
+        MetricsServer(server.metrics,
+                      args.metrics_address, args.metrics_port).start()
     input_thread: Thread = Thread(
         target=_input_handler,
-        args=(server,),
+        args=(server.stats, server.stop),
         daemon=True)
     input_thread.start()
     server.run()
+    server.cache.save_cache()
 
 
 if __name__ == "__main__":
@@ -45,4 +136,127 @@ if __name__ == "__main__":
         help="Server port",
         default=53
     )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        help="Number of worker processes sharing the port (SO_REUSEPORT) "
+             "and a shared-memory cache",
+        default=1
+    )
+    parser.add_argument(
+        "--upstream", "-u",
+        type=str,
+        action="append",
+        help="Upstream DNS server as host[:port], can be repeated "
+             "(default: 8.8.8.8)"
+    )
+    parser.add_argument(
+        "--timeout", "-t",
+        type=float,
+        help="How long to wait for an upstream reply, seconds",
+        default=5
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Ask the next fastest upstream when a reply is late"
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help="RTT percentile of the chosen upstream after which to hedge",
+        default=DEFAULT_HEDGE_PERCENTILE
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Maximum number of cached answers",
+        default=100_000
+    )
+    parser.add_argument(
+        "--cache-memory",
+        type=int,
+        help="Approximate cache memory budget in MiB",
+        default=64
+    )
+    parser.add_argument(
+        "--negative-ttl",
+        type=int,
+        help="Upper bound for caching NXDOMAIN/NODATA answers, seconds",
+        default=DEFAULT_NEGATIVE_TTL
+    )
+    parser.add_argument(
+        "--prefetch-fraction",
+        type=float,
+        help="Refresh hot entries within this fraction of their TTL, "
+             "0 disables prefetching",
+        default=DEFAULT_PREFETCH_FRACTION
+    )
+    parser.add_argument(
+        "--prefetch-hits",
+        type=int,
+        help="Hits an entry needs before it is prefetched",
+        default=DEFAULT_PREFETCH_HITS
+    )
+    parser.add_argument(
+        "--prefetch-rate",
+        type=float,
+        help="Maximum prefetch queries per second",
+        default=DEFAULT_PREFETCH_RATE
+    )
+    parser.add_argument(
+        "--zone",
+        type=str,
+        action="append",
+        default=[],
+        help="Answer names of this zone file locally, can be repeated"
+    )
+    parser.add_argument(
+        "--hosts",
+        type=str,
+        action="append",
+        default=[],
+        help="Answer names of this hosts file locally, can be repeated"
+    )
+    parser.add_argument(
+        "--blocklist",
+        type=str,
+        action="append",
+        default=[],
+        help="Answer NXDOMAIN for these domains and their subdomains, "
+             "can be repeated"
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        help="How often to check local files for changes, seconds, "
+             "0 disables reloading",
+        default=DEFAULT_RELOAD_INTERVAL
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve /metrics and /metrics.json on this port, 0 disables; "
+             "worker N uses port + N",
+        default=0
+    )
+    parser.add_argument(
+        "--metrics-address",
+        type=str,
+        help="Address for the metrics endpoint",
+        default='127.0.0.1'
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=['debug', 'info', 'warning', 'error'],
+        help="Per-request logs are written at info level",
+        default='warning'
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=float,
+        help="Fraction of requests to log at info level",
+        default=1.0
+    )
     _main(parser.parse_args())
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import urllib.request
+from pathlib import Path
+from time import monotonic
+
+from dns.bench.load import (LoadGenerator, encode_query, trace_queries,
+                            zipf_queries)
+from dns.bench.upstream import FakeUpstream
+
+_ROOT = Path(__file__).resolve().parents[2]
+_STARTUP_TIMEOUT = 15
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rss(pid: int) -> int:
+    # Resident memory of the server and its worker processes, in bytes.
+    # Pages of a shared cache are counted once per worker.
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for process in pids:
+        try:
+            with open(f'/proc/{process}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def _metrics(port: int) -> dict:
+    with urllib.request.urlopen(
+            f'http://127.0.0.1:{port}/metrics.json', timeout=2) as response:
+        return json.load(response)
+
+
+def _values(text: str) -> list[float]:
+    return [float(value) for value in text.split(',')]
+
+
+def _upstreams(args: argparse.Namespace) -> list[FakeUpstream]:
+    # One fake upstream per position of the comma-separated lists; a
+    # shorter list repeats its last value
+    lists = [_values(args.upstream_latency), _values(args.upstream_jitter),
+             _values(args.upstream_loss), _values(args.upstream_slow)]
+    count = max(len(values) for values in lists)
+    upstreams = []
+    for i in range(count):
+        latency, jitter, loss, slow = (values[min(i, len(values) - 1)]
+                                       for values in lists)
+        upstreams.append(FakeUpstream(
+            latency=latency / 1000, jitter=jitter / 1000, loss=loss,
+            ttl=args.ttl, slow=slow,
+            slow_latency=args.upstream_slow_latency / 1000))
+    return upstreams
+
+
+class _Server:
+    def __init__(self, args: argparse.Namespace, upstream_ports: list[int],
+                 workdir: str, extra_args: list[str]):
+        self.port = _free_port()
+        self.metrics_port = _free_port()
+        command = [sys.executable, '-m', 'dns',
+                   '-a', '127.0.0.1', '-p', str(self.port),
+                   *(argument for port in upstream_ports
+                     for argument in ('-u', f'127.0.0.1:{port}')),
+                   '--metrics-port', str(self.metrics_port),
+                   *shlex.split(args.server_args), *extra_args]
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [str(_ROOT), env.get('PYTHONPATH')]))
+        self._process = subprocess.Popen(
+            command, cwd=workdir, env=env, stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, text=True)
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    async def wait_ready(self):
+        probe = encode_query('ready.bench.test.', 1)
+        loop = asyncio.get_running_loop()
+        deadline = monotonic() + _STARTUP_TIMEOUT
+        while monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("DNS server exited during startup")
+            try:
+                await loop.run_in_executor(None, _metrics, self.metrics_port)
+                await asyncio.wait_for(self._ask(probe), 0.5)
+                return
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.2)
+        raise RuntimeError("DNS server did not start in time")
+
+    async def _ask(self, query: bytes):
+        loop = asyncio.get_running_loop()
+        answered = loop.create_future()
+
+        class Probe(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if not answered.done():
+                    answered.set_result(data)
+
+        transport, _ = await loop.create_datagram_endpoint(
+            Probe, remote_addr=('127.0.0.1', self.port))
+        try:
+            transport.sendto(query)
+            await answered
+        finally:
+            transport.close()
+
+    def stop(self):
+        # quit lets the server save its cache like an operator would
+        try:
+            self._process.communicate('quit\n', timeout=30)
+        except (subprocess.TimeoutExpired, BrokenPipeError):
+            self._process.kill()
+            self._process.wait()
+
+
+async def _sample_rss(pid: int, peak: list[int]):
+    while True:
+        peak[0] = max(peak[0], _rss(pid))
+        await asyncio.sleep(0.5)
+
+
+async def _bench(args: argparse.Namespace, workdir: str,
+                 extra_args: list[str] = ()) -> dict:
+    upstreams = _upstreams(args)
+    for upstream in upstreams:
+        await upstream.start()
+    server = _Server(args, [upstream.port for upstream in upstreams],
+                     workdir, list(extra_args))
+    loop = asyncio.get_running_loop()
+    try:
+        await server.wait_ready()
+        queries = (trace_queries(args.trace) if args.trace else
+                   zipf_queries(args.names, args.zipf, args.seed))
+        target = ('127.0.0.1', server.port)
+        if args.warmup:
+            await LoadGenerator(target, queries, args.qps, args.sockets,
+                                args.timeout).run(args.warmup)
+
+        before = await loop.run_in_executor(None, _metrics,
+                                            server.metrics_port)
+        upstream_before = [upstream.queries for upstream in upstreams]
+        rss_start = _rss(server.pid)
+        peak = [rss_start]
+        sampler = asyncio.create_task(_sample_rss(server.pid, peak))
+        result = await LoadGenerator(target, queries, args.qps, args.sockets,
+                                     args.timeout).run(args.duration)
+        sampler.cancel()
+        after = await loop.run_in_executor(None, _metrics,
+                                           server.metrics_port)
+        rss_end = _rss(server.pid)
+    finally:
+        await loop.run_in_executor(None, server.stop)
+        for upstream in upstreams:
+            upstream.close()
+
+    hits = after['dns_cache_hits_total'] - before['dns_cache_hits_total']
+    misses = (after['dns_cache_misses_total']
+              - before['dns_cache_misses_total'])
+    mib = 1024 * 1024
+    return {
+        'target_qps': args.qps,
+        'sent': result.sent,
+        'answered': result.answered,
+        'lost': result.lost,
+        'throughput_qps': round(result.answered / result.elapsed, 1),
+        'latency_p50_ms': round(result.percentile(0.5) * 1000, 3),
+        'latency_p99_ms': round(result.percentile(0.99) * 1000, 3),
+        'latency_p999_ms': round(result.percentile(0.999) * 1000, 3),
+        'cache_hit_ratio': round(hits / (hits + misses), 4)
+        if hits + misses else 0.0,
+        'upstream_queries': [upstream.queries - before_count
+                             for upstream, before_count
+                             in zip(upstreams, upstream_before)],
+        'hedged': after['dns_hedged_total'] - before['dns_hedged_total'],
+        'cache_entries': after['dns_cache_entries'],
+        'rss_start_mib': round(rss_start / mib, 1),
+        'rss_end_mib': round(rss_end / mib, 1),
+        'rss_peak_mib': round(peak[0] / mib, 1),
+        'rss_growth_mib': round((rss_end - rss_start) / mib, 1),
+    }
+
+
+def _run(args: argparse.Namespace, extra_args: list[str] = ()) -> dict:
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        return asyncio.run(_bench(args, args.workdir, extra_args))
+    with tempfile.TemporaryDirectory() as workdir:
+        return asyncio.run(_bench(args, workdir, extra_args))
+
+
+def _main(args: argparse.Namespace):
+    if args.compare_hedge:
+        # The same load twice, each from a cold cache
+        report = {'no_hedge': _run(args), 'hedge': _run(args, ['--hedge'])}
+    else:
+        report = _run(args)
+    if args.json:
+        print(json.dumps(report))
+        return
+    if args.compare_hedge:
+        for key in report['hedge']:
+            print(f"{key}: {report['no_hedge'][key]} -> "
+                  f"{report['hedge'][key]}")
+        return
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline load benchmark for the DNS server"
+    )
+    parser.add_argument(
+        "--qps",
+        type=float,
+        help="Target queries per second",
+        default=2000
+    )
+    parser.add_argument(
+        "--duration", "-d",
+        type=float,
+        help="Measured run length, seconds",
+        default=10
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        help="Unmeasured load before the run, seconds",
+        default=0
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        help="Replay queries from a file of \"name [type]\" lines "
+             "instead of a synthetic workload"
+    )
+    parser.add_argument(
+        "--names",
+        type=int,
+        help="Number of distinct names in the synthetic workload",
+        default=10_000
+    )
+    parser.add_argument(
+        "--zipf",
+        type=float,
+        help="Zipf exponent of name popularity",
+        default=1.0
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed of the synthetic workload",
+        default=1
+    )
+    parser.add_argument(
+        "--sockets",
+        type=int,
+        help="Client sockets to spread queries over",
+        default=4
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="How long to wait for stragglers after the run, seconds",
+        default=2
+    )
+    parser.add_argument(
+        "--upstream-latency",
+        type=str,
+        help="Fake upstream reply delay, ms; a comma-separated list "
+             "starts one fake upstream per value, e.g. 20,200",
+        default='20'
+    )
+    parser.add_argument(
+        "--upstream-jitter",
+        type=str,
+        help="Uniform extra delay of the fake upstream, ms, or a list "
+             "with a value per upstream",
+        default='5'
+    )
+    parser.add_argument(
+        "--upstream-loss",
+        type=str,
+        help="Fraction of queries the fake upstream drops, or a list "
+             "with a value per upstream",
+        default='0'
+    )
+    parser.add_argument(
+        "--upstream-slow",
+        type=str,
+        help="Fraction of replies the fake upstream delays by "
+             "--upstream-slow-latency, or a list with a value per upstream",
+        default='0'
+    )
+    parser.add_argument(
+        "--upstream-slow-latency",
+        type=float,
+        help="Extra delay of the slow replies, ms",
+        default=500
+    )
+    parser.add_argument(
+        "--compare-hedge",
+        action="store_true",
+        help="Run twice, without and with --hedge, and report both"
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        help="TTL of fake upstream answers, seconds",
+        default=300
+    )
+    parser.add_argument(
+        "--server-args",
+        type=str,
+        help="Extra arguments for the DNS server, e.g. \"--workers 2\"",
+        default=''
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        help="Run the server here and keep its cache journal between "
+             "runs (default: a fresh temporary directory)"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the report as one JSON object"
+    )
+    _main(parser.parse_args())
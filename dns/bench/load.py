@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import random
+import struct
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Iterator
+
+from dnslib import QTYPE
+
+from dns import wire
+
+_FLAGS_RD = 0x0100
+_CLASS_IN = 1
+# Queries sent per tick are capped so a stalled loop catches up
+# in bursts instead of flooding the server at once.
+_MAX_BURST = 1000
+_TICK = 0.001
+
+
+def encode_query(qname: str, qtype: int) -> bytes:
+    labels = [label.encode() for label in qname.rstrip('.').split('.')
+              if label]
+    name = b''.join(bytes([len(label)]) + label for label in labels)
+    return (wire.HEADER.pack(0, _FLAGS_RD, 1, 0, 0, 0) + name + b'\x00'
+            + struct.pack(">HH", qtype, _CLASS_IN))
+
+
+def zipf_queries(names: int, exponent: float,
+                 seed: int | None = None) -> Iterator[bytes]:
+    # Rank r is asked with probability proportional to 1 / r^exponent
+    rng = random.Random(seed)
+    queries = [encode_query(f'host{rank}.bench.test.', QTYPE.A)
+               for rank in range(1, names + 1)]
+    weights = list(itertools.accumulate(
+        1 / rank ** exponent for rank in range(1, names + 1)))
+    while True:
+        yield from rng.choices(queries, cum_weights=weights, k=1024)
+
+
+def trace_queries(path: str) -> Iterator[bytes]:
+    # One "name [type]" per line, replayed in order and looped
+    queries = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            qtype = fields[1] if len(fields) > 1 else 'A'
+            queries.append(encode_query(
+                fields[0],
+                int(qtype) if qtype.isdigit() else getattr(QTYPE,
+                                                           qtype.upper())))
+    if not queries:
+        raise ValueError(f"No queries in {path}")
+    return itertools.cycle(queries)
+
+
+@dataclass
+class LoadResult:
+    sent: int = 0
+    answered: int = 0
+    lost: int = 0
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+# Open-loop load: queries go out on schedule at the target rate whether
+# or not earlier ones were answered, so a slow server shows up as
+# latency and loss rather than as a lower offered rate. Queries are
+# spread round-robin over several sockets, which also spreads them over
+# SO_REUSEPORT workers.
+class LoadGenerator:
+    def __init__(self, target: tuple[str, int], queries: Iterator[bytes],
+                 qps: float, sockets: int = 4, timeout: float = 2):
+        self._target = target
+        self._queries = queries
+        self._qps = qps
+        self._sockets = sockets
+        self._timeout = timeout
+
+    async def run(self, duration: float) -> LoadResult:
+        loop = asyncio.get_running_loop()
+        result = LoadResult()
+        protocols = []
+        for _ in range(self._sockets):
+            _, protocol = await loop.create_datagram_endpoint(
+                lambda: _LoadProtocol(result),
+                remote_addr=self._target)
+            protocols.append(protocol)
+        try:
+            started = perf_counter()
+            turn = itertools.cycle(protocols)
+            while True:
+                now = perf_counter()
+                if now - started >= duration:
+                    break
+                due = min(int((now - started) * self._qps) - result.sent,
+                          _MAX_BURST)
+                for _ in range(due):
+                    next(turn).send(next(self._queries))
+                result.sent += max(due, 0)
+                await asyncio.sleep(_TICK)
+            result.elapsed = perf_counter() - started
+            deadline = perf_counter() + self._timeout
+            while (perf_counter() < deadline
+                   and any(protocol.pending for protocol in protocols)):
+                await asyncio.sleep(0.01)
+        finally:
+            for protocol in protocols:
+                result.lost += len(protocol.pending) + protocol.overwritten
+                protocol.close()
+        return result
+
+
+class _LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, result: LoadResult):
+        self._result = result
+        self._transport: asyncio.DatagramTransport | None = None
+        self._next_id = random.randrange(0x10000)
+        self.pending: dict[int, float] = {}
+        self.overwritten = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def send(self, query: bytes):
+        txid = self._next_id
+        self._next_id = (txid + 1) & 0xFFFF
+        if txid in self.pending:
+            # Still unanswered after a full lap of IDs
+            self.overwritten += 1
+        self.pending[txid] = perf_counter()
+        self._transport.sendto(struct.pack(">H", txid) + query[2:])
+
+    def close(self):
+        self._transport.close()
+
+    def datagram_received(self, data, addr):
+        if len(data) < wire.HEADER.size:
+            return
+        txid, = struct.unpack_from(">H", data)
+        sent_at = self.pending.pop(txid, None)
+        if sent_at is not None:
+            self._result.answered += 1
+            self._result.latencies.append(perf_counter() - sent_at)
+
+    def error_received(self, exc):
+        pass
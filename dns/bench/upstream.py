@@ -0,0 +1,117 @@
+import asyncio
+import random
+import struct
+import zlib
+
+from dns import wire
+
+_TYPE_A = 1
+_TYPE_AAAA = 28
+_TYPE_SOA = 6
+_CLASS_IN = 1
+# Answers point back at the question name
+_NAME_POINTER = b'\xc0\x0c'
+_FLAGS_RESPONSE = 0x8180
+_RCODE_SERVFAIL = 2
+
+
+# A stand-in upstream resolver for offline benchmarks. Every name
+# exists: A and AAAA queries get one record with an address derived
+# from the name, other types get an empty answer with an SOA so that
+# negative caching is exercised too. Replies are delayed by latency
+# plus uniform jitter, a slow fraction of them by slow_latency on top,
+# and a loss fraction of queries is dropped.
+class FakeUpstream:
+    def __init__(self, address: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 loss: float = 0.0, ttl: int = 300, slow: float = 0.0,
+                 slow_latency: float = 0.5):
+        self.address = address
+        self.port = port
+        self._latency = latency
+        self._jitter = jitter
+        self._loss = loss
+        self._slow = slow
+        self._slow_latency = slow_latency
+        self._ttl = ttl
+        self._transport: asyncio.DatagramTransport | None = None
+
+        self.queries = 0
+        self.dropped = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _FakeUpstreamProtocol(self),
+            local_addr=(self.address, self.port))
+        self.port = self._transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _on_query(self, data: bytes, addr):
+        self.queries += 1
+        if self._loss and random.random() < self._loss:
+            self.dropped += 1
+            return
+        response = self._answer(data)
+        if response is None:
+            return
+        delay = self._latency
+        if self._jitter:
+            delay += random.uniform(0, self._jitter)
+        if self._slow and random.random() < self._slow:
+            delay += self._slow_latency
+        if delay > 0:
+            asyncio.get_running_loop().call_later(
+                delay, self._send, response, addr)
+        else:
+            self._send(response, addr)
+
+    def _send(self, response: bytes, addr):
+        if not self._transport.is_closing():
+            self._transport.sendto(response, addr)
+
+    def _answer(self, data: bytes) -> bytes | None:
+        question = wire.parse_question(data)
+        if question is None:
+            if len(data) < wire.HEADER.size:
+                return None
+            txid, = struct.unpack_from(">H", data)
+            return wire.HEADER.pack(txid, _FLAGS_RESPONSE | _RCODE_SERVFAIL,
+                                    0, 0, 0, 0)
+        txid, = struct.unpack_from(">H", data)
+        answers = b''
+        authority = b''
+        digest = zlib.crc32(question.qname.encode())
+        if question.qtype == _TYPE_A:
+            answers = _record(_TYPE_A, self._ttl,
+                              bytes([10]) + digest.to_bytes(4, 'big')[1:])
+        elif question.qtype == _TYPE_AAAA:
+            answers = _record(_TYPE_AAAA, self._ttl,
+                              b'\xfd' + bytes(11) + digest.to_bytes(4, 'big'))
+        else:
+            # Root names for MNAME and RNAME, then serial, refresh,
+            # retry, expire and minimum
+            soa = b'\x00\x00' + struct.pack(">IIIII", 1, 3600, 600,
+                                            86400, self._ttl)
+            authority = _record(_TYPE_SOA, self._ttl, soa)
+        header = wire.HEADER.pack(txid, _FLAGS_RESPONSE, 1,
+                                  1 if answers else 0, 1 if authority else 0,
+                                  0)
+        return header + data[wire.HEADER.size:question.end] \
+            + answers + authority
+
+
+class _FakeUpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, upstream: FakeUpstream):
+        self._upstream = upstream
+
+    def datagram_received(self, data, addr):
+        self._upstream._on_query(data, addr)
+
+
+def _record(rtype: int, ttl: int, rdata: bytes) -> bytes:
+    return (_NAME_POINTER + struct.pack(">HHIH", rtype, _CLASS_IN, ttl,
+                                        len(rdata)) + rdata)
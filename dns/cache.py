@@ -1,31 +1,74 @@
-import pickle
-import os
-from collections import defaultdict
+import gc
+import heapq
+from collections import OrderedDict
 from time import time
 from threading import Timer, Lock
 
-DEFAULT_CACHE_FILE = 'dns_cache.pkl'
+from dns.journal import CacheJournal
+
+DEFAULT_CACHE_FILE = 'dns_cache.journal'
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_EXPIRE_BATCH = 10_000
+# The journal is compacted once it holds this many times more records
+# than the cache, plus a fixed slack so small caches are left alone.
+_COMPACT_RATIO = 2
+_COMPACT_SLACK = 10_000
+
+# Rough per-entry cost of the key, tuple, dict slot and heap item,
+# used to keep the memory budget cheap to track.
+_ENTRY_OVERHEAD = 200
 
 
 class DNSCache:
-    def __init__(self, cleanup_interval=600, file=DEFAULT_CACHE_FILE):
+    def __init__(self, cleanup_interval=1, file=DEFAULT_CACHE_FILE,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 expire_batch=DEFAULT_EXPIRE_BATCH):
+        self.lock = Lock()
+        # One compaction at a time: the GC timer and save_cache share
+        # the snapshot file and the journal's pending records
+        self._compaction_lock = Lock()
+
         self.file = file
-        self.cache = defaultdict(dict)
+        self.cache = OrderedDict()
         self.cleanup_interval = cleanup_interval
+        self.expire_batch = expire_batch
+        self._expiry = []
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._journal = CacheJournal(file) if file is not None else None
         self._load_cache()
         self._start_gc_timer()
 
-        self.lock = Lock()
+    def __len__(self):
+        return len(self.cache)
 
-    def get(self, qname, qtype):
+    def get(self, qname, qtype, count=True):
+        # count=False is for internal lookups that are not client
+        # queries and should not skew the hit ratio
         with self.lock:
             try:
-                if qtype not in self.cache or qname not in self.cache[qtype]:
+                key = (qname, qtype)
+                entry = self.cache.get(key)
+                if entry is None:
+                    self.misses += count
                     return None
-                expire_time, records = self.cache[qtype][qname]
+                expire_time, records, size = entry
                 if time() > expire_time:
-                    self.cache[qtype].pop(qname, None)
+                    self._remove(key)
+                    self.expirations += 1
+                    self.misses += count
                     return None
+                self.cache.move_to_end(key)
+                self.hits += count
                 return records
             except Exception as e:
                 print(f"Cache get error: {e}")
@@ -36,20 +79,63 @@ class DNSCache:
             try:
                 if not records:
                     return
+                key = (qname, qtype)
                 expire_time = time() + ttl
-                self.cache[qtype][qname] = (expire_time, records)
+                self._insert(key, expire_time, records)
+                if self._journal is not None:
+                    self._journal.append(key, expire_time, records)
             except Exception as e:
                 print(f"Couldn't put: {e}")
 
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.cache),
+                'bytes': self.size_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
     def save_cache(self):
+        if self._journal is None:
+            return
         try:
-            with open(self.file, 'wb') as cache_file:
-                self._clear()
-                pickle.dump(dict(self.cache), cache_file)
-                print("Cache was saved")
+            self._expire()
+            self._compact_journal()
+            with self.lock:
+                self._journal.flush(sync=True)
+            print("Cache was saved")
         except Exception as e:
             print(f"Couldn't save cache: {e}")
 
+    def _insert(self, key, expire_time, records):
+        self._remove(key)
+        size = self._estimate_size(key, records)
+        self.cache[key] = (expire_time, records, size)
+        self.size_bytes += size
+        heapq.heappush(self._expiry, (expire_time, key))
+        self._evict()
+        self._compact_expiry()
+
+    def _remove(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[2]
+
+    def _evict(self):
+        while self.cache and (len(self.cache) > self.max_entries
+                              or self.size_bytes > self.max_bytes):
+            _, (_, _, size) = self.cache.popitem(last=False)
+            self.size_bytes -= size
+            self.evictions += 1
+
+    @staticmethod
+    def _estimate_size(key, records):
+        qname, _ = key
+        return _ENTRY_OVERHEAD + len(qname) + records.size
+
     def _start_gc_timer(self):
         self.gc = Timer(self.cleanup_interval,
                         self._periodic_cleanup)
@@ -57,41 +143,104 @@ class DNSCache:
         self.gc.start()
 
     def _periodic_cleanup(self):
-        self._clear()
+        self._expire(self.expire_batch)
+        self._maintain_journal()
         self._start_gc_timer()
 
-    def _clear(self):
+    def _maintain_journal(self):
+        if self._journal is None:
+            return
         try:
-            current_time = time()
-            for qtype in list(self.cache.keys()):
-                self.cache[qtype] = {
-                    qname: data for qname, data in self.cache[qtype].items()
-                    if current_time <= data[0]
-                }
+            with self.lock:
+                self._journal.flush()
+                oversized = (self._journal.records > _COMPACT_RATIO
+                             * len(self.cache) + _COMPACT_SLACK)
+            if oversized:
+                self._compact_journal()
+        except Exception as e:
+            print(f"Couldn't maintain cache journal: {e}")
+
+    def _compact_journal(self):
+        with self._compaction_lock:
+            with self.lock:
+                current_time = time()
+                entries = [(key, expire_time, records)
+                           for key, (expire_time, records, _)
+                           in self.cache.items()
+                           if current_time <= expire_time]
+                self._journal.begin_compaction()
+            # The snapshot is written without the lock; puts made
+            # meanwhile are kept aside and appended to it before it
+            # replaces the journal.
+            count = self._journal.write_snapshot(entries)
+            with self.lock:
+                self._journal.finish_compaction(count)
+
+    def _expire(self, limit=None):
+        try:
+            with self.lock:
+                current_time = time()
+                expiry = self._expiry
+                popped = 0
+                while expiry and expiry[0][0] < current_time:
+                    if limit is not None and popped >= limit:
+                        break
+                    expire_time, key = heapq.heappop(expiry)
+                    popped += 1
+                    entry = self.cache.get(key)
+                    # Heap items of overwritten or evicted entries are stale
+                    if entry is not None and entry[0] == expire_time:
+                        self._remove(key)
+                        self.expirations += 1
         except Exception as e:
             print(f"Couldn't clear: {e}")
 
+    def _compact_expiry(self):
+        # Evicted and overwritten entries leave stale heap items behind;
+        # rebuilding once they dominate keeps the heap O(len(cache)).
+        if len(self._expiry) > 2 * len(self.cache) + 1024:
+            self._expiry = [(entry[0], key)
+                            for key, entry in self.cache.items()]
+            heapq.heapify(self._expiry)
+
     def _load_cache(self):
+        if self._journal is None:
+            return
+        # Millions of small objects would otherwise trigger repeated
+        # full collections while the cache is being filled.
+        gc_enabled = gc.isenabled()
+        gc.disable()
         try:
-            if os.path.exists(self.file):
-                with open(self.file, 'rb') as f:
-                    loaded_cache = pickle.load(f)
-                    current_time = time()
-                    for qtype, records in loaded_cache.items():
-                        self.cache[qtype] = {
-                            qname: data for qname, data in records.items()
-                            if current_time <= data[0]
-                        }
+            with self.lock:
+                # Bulk load: the heap is built and the budget enforced once
+                cache = self.cache
+                for key, expire_time, records in self._journal.load(time()):
+                    if key in cache:
+                        self._remove(key)
+                    size = self._estimate_size(key, records)
+                    cache[key] = (expire_time, records, size)
+                    self.size_bytes += size
+                self._expiry = [(entry[0], key)
+                                for key, entry in self.cache.items()]
+                heapq.heapify(self._expiry)
+                self._evict()
+            if self.cache:
                 print("Cache was loaded")
             else:
                 print("Cache is empty")
         except Exception as e:
-            print(f"Couldn't load cache: {e}")
+            print(f"Couldn't load cache, persistence disabled: {e}")
+            self._journal = None
+        finally:
+            if gc_enabled:
+                gc.enable()
 
     def __del__(self):
-        self.save_cache()
         try:
             if self.gc:
                 self.gc.cancel()
         except Exception as e:
             print(f"Timer cleanup error: {e}")
+        if self._journal is not None:
+            self.save_cache()
+            self._journal.close()
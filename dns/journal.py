@@ -0,0 +1,144 @@
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterable, Iterator
+
+from dns.wire import CachedResponse
+
+_MAGIC = b'DNSCJ001'
+# crc32, expire_time, stored_at, qtype, question_end,
+# qname length, wire length, number of TTL fields
+_HEADER = struct.Struct(">IddHHHHH")
+_TTL_ITEM = struct.Struct(">HI")
+
+Entry = tuple[tuple[str, int], float, CachedResponse]
+
+
+class CacheJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self._file = None
+        self._pending: list[bytes] | None = None
+
+    def load(self, now: float) -> Iterator[Entry]:
+        good = 0
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(_MAGIC)) == _MAGIC:
+                    good = len(_MAGIC)
+                    if os.fstat(f.fileno()).st_size > good:
+                        with mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ) as data:
+                            yield from self._read_records(data, now)
+                        good = self._good_offset
+        except FileNotFoundError:
+            pass
+        self._open(good)
+
+    def append(self, key: tuple[str, int], expire_time: float,
+               cached: CachedResponse):
+        record = _encode(key, expire_time, cached)
+        self._file.write(record)
+        self.records += 1
+        if self._pending is not None:
+            self._pending.append(record)
+
+    def flush(self, sync: bool = False):
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def begin_compaction(self):
+        self._pending = []
+
+    def write_snapshot(self, entries: Iterable[Entry]) -> int:
+        count = 0
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(_MAGIC)
+            for key, expire_time, cached in entries:
+                f.write(_encode(key, expire_time, cached))
+                count += 1
+        return count
+
+    def finish_compaction(self, snapshot_records: int):
+        pending, self._pending = self._pending, None
+        with open(self.path + '.tmp', 'ab') as f:
+            for record in pending:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+        self._file = open(self.path, 'ab')
+        self.records = snapshot_records + len(pending)
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self.flush(sync=True)
+            self._file.close()
+
+    def _read_records(self, data: mmap.mmap, now: float) -> Iterator[Entry]:
+        size = len(data)
+        view = memoryview(data)
+        offset = self._good_offset = len(_MAGIC)
+        try:
+            while offset + _HEADER.size <= size:
+                (crc, expire_time, stored_at, qtype, question_end,
+                 name_length, wire_length,
+                 ttl_count) = _HEADER.unpack_from(data, offset)
+                body_start = offset + _HEADER.size
+                wire_start = body_start + name_length
+                wire_end = wire_start + wire_length
+                end = wire_end + ttl_count * _TTL_ITEM.size
+                if end > size:
+                    # A torn write at the tail is where the last run stopped
+                    return
+
+                if expire_time < now:
+                    # Expired records are skipped without being decoded
+                    offset = self._good_offset = end
+                    self.records += 1
+                    continue
+
+                if zlib.crc32(view[offset + 4:end]) != crc:
+                    return
+                try:
+                    qname = data[body_start:wire_start].decode()
+                except UnicodeDecodeError:
+                    return
+                if ttl_count == 1:
+                    ttls = [_TTL_ITEM.unpack_from(data, wire_end)]
+                else:
+                    ttls = list(_TTL_ITEM.iter_unpack(view[wire_end:end]))
+                cached = CachedResponse(data[wire_start:wire_end],
+                                        question_end, ttls, stored_at)
+                offset = self._good_offset = end
+                self.records += 1
+                yield (qname, qtype), expire_time, cached
+        finally:
+            view.release()
+
+    def _open(self, good: int):
+        if good == 0:
+            with open(self.path, 'wb') as f:
+                f.write(_MAGIC)
+        else:
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+        self._file = open(self.path, 'ab')
+
+
+def _encode(key: tuple[str, int], expire_time: float,
+            cached: CachedResponse) -> bytes:
+    qname, qtype = key
+    name = qname.encode()
+    body = b''.join([name, cached.wire,
+                     *(_TTL_ITEM.pack(offset, ttl)
+                       for offset, ttl in cached.ttls)])
+    header = _HEADER.pack(0, expire_time, cached.stored_at, qtype,
+                          cached.question_end, len(name), len(cached.wire),
+                          len(cached.ttls))
+    record = header[4:] + body
+    return struct.pack(">I", zlib.crc32(record)) + record
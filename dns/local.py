@@ -0,0 +1,307 @@
+import ipaddress
+import logging
+import os
+import struct
+from threading import Lock, Timer
+
+from dnslib import (A, AAAA, PTR, QTYPE, RCODE, RR, DNSHeader, DNSQuestion,
+                    DNSRecord)
+
+from dns import wire
+
+DEFAULT_RELOAD_INTERVAL = 5
+DEFAULT_LOCAL_TTL = 300
+# Longest CNAME chain followed inside local data
+_MAX_CHAIN = 8
+# QR and RA; RD is copied from the query
+_FLAGS_RESPONSE = 0x8080
+_FLAG_RD = 0x0100
+# Lines every hosts-style blocklist carries that must not be blocked
+_HOSTS_BOILERPLATE = {'localhost.', 'localhost.localdomain.', 'local.',
+                      'broadcasthost.', 'ip6-localhost.', 'ip6-loopback.',
+                      '0.0.0.0.'}
+# Always answered, as the server used to special-case the reverse
+# lookup of 127.0.0.1
+_BUILTIN_HOSTS = (('127.0.0.1', 'localhost'), ('::1', 'localhost'))
+
+# What broken local data fails to load with
+_LOAD_ERRORS = (OSError, ValueError, UnicodeDecodeError)
+
+_logger = logging.getLogger('dns.local')
+
+
+# An immutable snapshot of all local data. Exact names are answered from
+# response templates built at load time; everything else is found by
+# walking the suffixes of the query name, which costs one hash lookup
+# per label however large the blocklists are.
+class _Index:
+    def __init__(self, records: dict[str, dict[int, list[RR]]],
+                 blocked: set[str]):
+        self.blocked = blocked
+        self.records = {}
+        self.wildcards = {}
+        self.zones = {}
+        for name, rrsets in records.items():
+            if name.startswith('*.'):
+                self.wildcards[name[2:]] = rrsets
+            else:
+                self.records[name] = rrsets
+            if QTYPE.SOA in rrsets:
+                self.zones[name] = rrsets[QTYPE.SOA][0]
+        self.templates = {}
+        for name, rrsets in self.records.items():
+            qtypes = set(rrsets)
+            if QTYPE.CNAME in rrsets:
+                qtypes.update((QTYPE.A, QTYPE.AAAA))
+            for qtype in qtypes:
+                self.templates[(name, qtype)] = bytes(
+                    self.response(name, qtype).pack())
+
+    def response(self, qname: str, qtype: int,
+                 rrsets: dict[int, list[RR]] | None = None) -> DNSRecord:
+        response = DNSRecord(DNSHeader(qr=1, aa=1, ra=1, rd=0),
+                             q=DNSQuestion(qname, qtype))
+        name = qname
+        if rrsets is None:
+            rrsets = self.records.get(name, {})
+        for _ in range(_MAX_CHAIN):
+            if qtype in rrsets or QTYPE.CNAME not in rrsets:
+                break
+            cname = rrsets[QTYPE.CNAME][0]
+            response.add_answer(_renamed(cname, name))
+            name = str(cname.rdata).lower()
+            rrsets = self.records.get(name)
+            if rrsets is None:
+                # The client resolves a target outside local data itself
+                return response
+        for rr in rrsets.get(qtype, ()):
+            response.add_answer(_renamed(rr, name))
+        if not response.rr:
+            self._add_soa(response, name)
+        return response
+
+    def _add_soa(self, response: DNSRecord, name: str):
+        for suffix in _suffixes(name):
+            soa = self.zones.get(suffix)
+            if soa is not None:
+                response.add_auth(soa)
+                return
+
+
+class LocalZones:
+    def __init__(self, zone_files=(), hosts_files=(), blocklists=(),
+                 reload_interval=DEFAULT_RELOAD_INTERVAL,
+                 ttl=DEFAULT_LOCAL_TTL):
+        self.zone_files = list(zone_files)
+        self.hosts_files = list(hosts_files)
+        self.blocklists = list(blocklists)
+        self.reload_interval = reload_interval
+        self.ttl = ttl
+        self._reload_lock = Lock()
+        self._timer = None
+        self._versions = None
+
+        self.answered = 0
+        self.blocked = 0
+        self.reloads = 0
+
+        try:
+            self._index = self._load()
+        except _LOAD_ERRORS as e:
+            # Served without the broken data; reloads retry it
+            _logger.warning("event=local_load_error error=%r", e)
+            self._index = _Index(self._builtin_records(), set())
+        if reload_interval and self._paths():
+            self._start_reload_timer()
+
+    def __len__(self):
+        index = self._index
+        return len(index.records) + len(index.wildcards) + len(index.blocked)
+
+    def answer(self, query: bytes, question: wire.Question) -> bytes | None:
+        # Reads a single reference, so a concurrent reload swaps the
+        # whole index between queries and never under one.
+        index = self._index
+        qname = question.qname
+        template = index.templates.get((qname, question.qtype))
+        if template is not None:
+            self.answered += 1
+            return _render(template, query, question.end)
+        if qname in index.records:
+            self.answered += 1
+            return _pack(index.response(qname, question.qtype),
+                         query, question)
+        for suffix in _suffixes(qname):
+            if suffix in index.blocked:
+                self.blocked += 1
+                return _refuse(query, question, RCODE.NXDOMAIN)
+            rrsets = index.wildcards.get(suffix)
+            if rrsets is not None:
+                # The wildcard's parent exists but owns no records
+                self.answered += 1
+                return _pack(
+                    index.response(qname, question.qtype,
+                                   rrsets if suffix != qname else {}),
+                    query, question)
+            if suffix in index.zones:
+                # Inside a local zone, so the name does not exist
+                self.answered += 1
+                response = DNSRecord(
+                    DNSHeader(qr=1, aa=1, ra=1, rd=0,
+                              rcode=RCODE.NXDOMAIN),
+                    q=DNSQuestion(qname, question.qtype),
+                    auth=[index.zones[suffix]])
+                return _pack(response, query, question)
+        return None
+
+    def reload(self, force=False) -> bool:
+        with self._reload_lock:
+            versions = self._file_versions()
+            if not force and versions == self._versions:
+                return False
+            try:
+                index = self._load()
+            except _LOAD_ERRORS as e:
+                _logger.warning("event=local_reload_error error=%r", e)
+                return False
+            self._index = index
+            self.reloads += 1
+            _logger.info("event=local_reload names=%s blocked=%s",
+                         len(index.records), len(index.blocked))
+            return True
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _load(self) -> _Index:
+        # Taken before reading, so a change made meanwhile is loaded
+        # by the next reload; recorded only once the files have loaded,
+        # so broken ones are retried
+        versions = self._file_versions()
+        records = self._builtin_records()
+        for path in self.zone_files:
+            with open(path) as f:
+                for rr in RR.fromZone(f.read(), ttl=self.ttl):
+                    _add(records, rr)
+        for path in self.hosts_files:
+            with open(path) as f:
+                for line in f:
+                    fields = line.partition('#')[0].split()
+                    for name in fields[1:]:
+                        self._add_host(records, fields[0], name)
+        blocked = set()
+        for path in self.blocklists:
+            blocked.update(_read_blocklist(path))
+        index = _Index(records, blocked)
+        self._versions = versions
+        return index
+
+    def _builtin_records(self) -> dict[str, dict[int, list[RR]]]:
+        records: dict[str, dict[int, list[RR]]] = {}
+        for address, name in _BUILTIN_HOSTS:
+            self._add_host(records, address, name)
+        return records
+
+    def _add_host(self, records, address, name):
+        ip = ipaddress.ip_address(address)
+        name = _normalize(name)
+        if ip.version == 4:
+            _add(records, RR(name, QTYPE.A, rdata=A(address), ttl=self.ttl))
+        else:
+            _add(records, RR(name, QTYPE.AAAA, rdata=AAAA(address),
+                             ttl=self.ttl))
+        reverse = ip.reverse_pointer + '.'
+        if QTYPE.PTR not in records.get(reverse, {}):
+            # The first name listed for an address is its canonical one
+            _add(records, RR(reverse, QTYPE.PTR, rdata=PTR(name),
+                             ttl=self.ttl))
+
+    def _paths(self):
+        return self.zone_files + self.hosts_files + self.blocklists
+
+    def _file_versions(self):
+        versions = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+                versions.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                versions.append(None)
+        return versions
+
+    def _start_reload_timer(self):
+        self._timer = Timer(self.reload_interval, self._reload_tick)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _reload_tick(self):
+        try:
+            self.reload()
+        finally:
+            self._start_reload_timer()
+
+
+def _add(records: dict[str, dict[int, list[RR]]], rr: RR):
+    name = str(rr.rname).lower()
+    records.setdefault(name, {}).setdefault(rr.rtype, []).append(rr)
+
+
+def _pack(response: DNSRecord, query: bytes,
+          question: wire.Question) -> bytes:
+    return _render(bytes(response.pack()), query, question.end)
+
+
+def _renamed(rr: RR, name: str) -> RR:
+    # Wildcard and chained records are answered under the asked name
+    return RR(name, rr.rtype, rr.rclass, rr.ttl, rr.rdata)
+
+
+def _normalize(name: str) -> str:
+    name = name.lower()
+    return name if name.endswith('.') else name + '.'
+
+
+def _read_blocklist(path: str):
+    # Plain "domain" lines and hosts-style "0.0.0.0 domain" lines;
+    # blocking a domain blocks everything under it
+    with open(path) as f:
+        for line in f:
+            fields = line.partition('#')[0].split()
+            if not fields:
+                continue
+            for name in fields[1:] if len(fields) > 1 else fields:
+                name = _normalize(name.removeprefix('*.'))
+                if name not in _HOSTS_BOILERPLATE:
+                    yield name
+
+
+def _suffixes(name: str):
+    # 'a.b.c.' -> 'a.b.c.', 'b.c.', 'c.'
+    start = 0
+    while start < len(name) - 1:
+        yield name[start:]
+        start = name.index('.', start) + 1
+
+
+def _render(template: bytes, query: bytes, question_end: int) -> bytes:
+    response = bytearray(template)
+    response[0:2] = query[0:2]
+    response_flags, = struct.unpack_from(">H", response, 2)
+    query_flags = wire.flags(query)
+    struct.pack_into(">H", response, 2,
+                     response_flags | query_flags & _FLAG_RD)
+    question = query[wire.HEADER.size:question_end]
+    template_end = wire.HEADER.size + len(question)
+    if response[wire.HEADER.size:template_end].lower() == question.lower():
+        # Echo the client's question so 0x20 letter casing survives
+        response[wire.HEADER.size:template_end] = question
+    return bytes(response)
+
+
+def _refuse(query: bytes, question: wire.Question, rcode: int) -> bytes:
+    txid, query_flags = struct.unpack_from(">HH", query)
+    return (wire.HEADER.pack(txid,
+                             _FLAGS_RESPONSE | query_flags & _FLAG_RD | rcode,
+                             1, 0, 0, 0)
+            + query[wire.HEADER.size:question.end])
@@ -0,0 +1,171 @@
+import bisect
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Callable
+
+DEFAULT_RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1, 2.5, 5)
+# Rates are taken over this many seconds, from counter samples at
+# least _RATE_STEP apart
+DEFAULT_RATE_WINDOW = 60.0
+_RATE_STEP = 1.0
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_RTT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters: dict[str, Counter] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+        self._histograms: dict[str, Histogram] = {}
+        self._rates: dict[str, deque[tuple[float, int]]] = {}
+
+    def counter(self, name: str) -> Counter:
+        return self._counters.setdefault(name, Counter())
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self._gauges[name] = read
+
+    def histogram(self, name: str, buckets=DEFAULT_RTT_BUCKETS) -> Histogram:
+        return self._histograms.setdefault(name, Histogram(buckets))
+
+    def rate(self, name: str, window: float = DEFAULT_RATE_WINDOW) -> float:
+        # Per-second rate of a counter over the last window seconds.
+        # Reads only add a sample when the last one is _RATE_STEP old,
+        # so any number of readers see the same window.
+        now = monotonic()
+        value = self.counter(name).value
+        samples = self._rates.setdefault(name, deque())
+        if not samples or now - samples[-1][0] >= _RATE_STEP:
+            samples.append((now, value))
+        # The newest sample from before the window is the baseline
+        while len(samples) > 1 and samples[1][0] <= now - window:
+            samples.popleft()
+        start, start_value = samples[0]
+        if now <= start:
+            return 0.0
+        return (value - start_value) / (now - start)
+
+    def snapshot(self) -> dict[str, float]:
+        values = {name: counter.value
+                  for name, counter in self._counters.items()}
+        for name, read in self._gauges.items():
+            values[name] = read()
+        for name, histogram in self._histograms.items():
+            base, labels = _split_labels(name)
+            values[f'{base}_count{labels}'] = histogram.count
+            values[f'{base}_sum{labels}'] = round(histogram.sum, 6)
+            for q in (0.5, 0.99):
+                values[f'{base}_p{int(q * 100)}{labels}'] = \
+                    histogram.quantile(q)
+        return values
+
+    def render(self) -> str:
+        lines = []
+        for name, counter in self._counters.items():
+            lines.append(f'{name} {counter.value}')
+        for name, read in self._gauges.items():
+            lines.append(f'{name} {read()}')
+        for name, histogram in self._histograms.items():
+            base, labels = _split_labels(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'{base}_bucket{_with_label(labels, "le", bound)} '
+                    f'{cumulative}')
+            lines.append(f'{base}_bucket{_with_label(labels, "le", "+Inf")} '
+                         f'{histogram.count}')
+            lines.append(f'{base}_count{labels} {histogram.count}')
+            lines.append(f'{base}_sum{labels} {histogram.sum}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, registry: MetricsRegistry,
+                 address: str = '127.0.0.1', port: int = 9153):
+        self._registry = registry
+        self._address = address
+        self._port = port
+        self._httpd: ThreadingHTTPServer | None = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(
+            (self._address, self._port), _make_handler(self._registry))
+        thread = threading.Thread(target=self._httpd.serve_forever,
+                                  daemon=True)
+        thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+
+def _make_handler(registry: MetricsRegistry):
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = registry.render().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(registry.snapshot()).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def _split_labels(name: str) -> tuple[str, str]:
+    base, brace, rest = name.partition('{')
+    return base, brace + rest
+
+
+def _with_label(labels: str, key: str, value) -> str:
+    label = f'{key}="{value}"'
+    if not labels:
+        return '{' + label + '}'
+    return labels[:-1] + ',' + label + '}'
@@ -0,0 +1,46 @@
+from time import monotonic
+
+from dns.wire import CachedResponse
+
+DEFAULT_PREFETCH_FRACTION = 0.1
+DEFAULT_PREFETCH_HITS = 3
+DEFAULT_PREFETCH_RATE = 50
+
+
+class Prefetcher:
+    def __init__(self,
+                 fraction: float = DEFAULT_PREFETCH_FRACTION,
+                 min_hits: int = DEFAULT_PREFETCH_HITS,
+                 rate: float = DEFAULT_PREFETCH_RATE):
+        self._fraction = fraction
+        self._min_hits = min_hits
+        self._rate = rate
+        self._tokens = float(rate)
+        self._last_refill = monotonic()
+
+        self.prefetched = 0
+        self.dropped = 0
+
+    def should_refresh(self, cached: CachedResponse, now: float) -> bool:
+        if self._fraction <= 0 or cached.hits < self._min_hits:
+            return False
+        ttl = cached.min_ttl
+        remaining = cached.stored_at + ttl - now
+        if remaining > ttl * self._fraction:
+            return False
+        if not self._take_token():
+            self.dropped += 1
+            return False
+        self.prefetched += 1
+        return True
+
+    def _take_token(self) -> bool:
+        current = monotonic()
+        self._tokens = min(float(self._rate),
+                           self._tokens
+                           + (current - self._last_refill) * self._rate)
+        self._last_refill = current
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
@@ -1,71 +1,374 @@
-import socket
-from dnslib import DNSRecord, QTYPE
+import asyncio
+import logging
+import random
+from time import time
+from dnslib import DNSHeader, DNSQuestion, DNSRecord, QTYPE, RCODE
+from dns import wire
 from dns.cache import DNSCache
+from dns.local import LocalZones
+from dns.metrics import MetricsRegistry
+from dns.prefetch import Prefetcher
+from dns.singleflight import SingleFlight
+from dns.upstream import UpstreamPool, DEFAULT_HEDGE_PERCENTILE
+
+DEFAULT_NEGATIVE_TTL = 3600
+_TCP_IDLE_TIMEOUT = 30
+# Longest CNAME chain followed in the cache
+_MAX_CHAIN = 8
+
+_logger = logging.getLogger('dns')
 
 
 class DNSServer:
-    def __init__(self, ip, port, remote_dns_server_ip):
+    def __init__(self, ip, port, upstreams, timeout=5,
+                 cache=None, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 prefetcher=None, hedge=False,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE,
+                 log_sample=1.0, reuse_port=False, local=None):
         self._dns_server_ip = ip
         self._port = port
-        self._dns_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._reuse_port = reuse_port
+        self._dns_server = None
+        self._tcp_server = None
+        self._log_sample = log_sample
+
+        self.metrics = MetricsRegistry()
+        self._requests = self.metrics.counter('dns_requests_total')
+        self._timeouts = self.metrics.counter('dns_upstream_failures_total')
+        self._errors = self.metrics.counter('dns_errors_total')
 
-        self._remote_dns_server = socket.socket(socket.AF_INET,
-                                                socket.SOCK_DGRAM)
-        self._remote_dns_server_ip = remote_dns_server_ip
+        self._remote_dns_server = UpstreamPool(
+            upstreams, timeout, hedge, hedge_percentile, self.metrics)
+        self._inflight = SingleFlight()
+        self._negative_ttl = negative_ttl
+        self._prefetcher = (prefetcher if prefetcher is not None
+                            else Prefetcher())
 
-        self.cache = DNSCache()
+        self._loop = None
+        self._stopped = None
+        self._tasks = set()
+
+        self.cache = cache if cache is not None else DNSCache()
+        self.local = local if local is not None else LocalZones()
+        self._register_metrics()
 
     def run(self):
-        with self._dns_server, self._remote_dns_server:
-            self._dns_server.bind((self._dns_server_ip, self._port))
+        asyncio.run(self._serve())
+
+    def stats(self):
+        return self.metrics.snapshot()
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        metrics.rate('dns_requests_total')
+        metrics.gauge('dns_qps', lambda: round(
+            metrics.rate('dns_requests_total'), 2))
+        metrics.gauge('dns_forwarded_total',
+                      lambda: self._inflight.forwarded)
+        metrics.gauge('dns_coalesced_total',
+                      lambda: self._inflight.coalesced)
+        metrics.gauge('dns_in_flight', lambda: len(self._inflight))
+        metrics.gauge('dns_prefetched_total',
+                      lambda: self._prefetcher.prefetched)
+        metrics.gauge('dns_prefetch_dropped_total',
+                      lambda: self._prefetcher.dropped)
+        metrics.gauge('dns_hedged_total',
+                      lambda: self._remote_dns_server.hedged)
+        for key in ('entries', 'bytes', 'hits', 'misses',
+                    'evictions', 'expirations'):
+            name = f'dns_cache_{key}' + (
+                '' if key in ('entries', 'bytes') else '_total')
+            metrics.gauge(name, lambda key=key: self.cache.stats()[key])
+        metrics.gauge('dns_cache_hit_ratio', self._hit_ratio)
+        metrics.gauge('dns_local_answers_total', lambda: self.local.answered)
+        metrics.gauge('dns_local_blocked_total', lambda: self.local.blocked)
+        metrics.gauge('dns_local_reloads_total', lambda: self.local.reloads)
+        for upstream in self._remote_dns_server.upstreams:
+            host, port = upstream.address
+            label = f'{{upstream="{host}:{port}"}}'
+            metrics.gauge(f'dns_upstream_srtt_seconds{label}',
+                          lambda u=upstream: round(u.srtt, 6))
+            metrics.gauge(f'dns_upstream_queries_total{label}',
+                          lambda u=upstream: u.queries)
+            metrics.gauge(f'dns_upstream_timeouts_total{label}',
+                          lambda u=upstream: u.timeouts)
+            metrics.gauge(f'dns_upstream_tcp_queries_total{label}',
+                          lambda u=upstream: u.tcp_queries)
+
+    def _hit_ratio(self):
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        return round(stats['hits'] / lookups, 4) if lookups else 0.0
+
+    def _should_log(self):
+        # Checked before any per-request formatting happens
+        return (_logger.isEnabledFor(logging.INFO)
+                and (self._log_sample >= 1
+                     or random.random() < self._log_sample))
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        await self._remote_dns_server.start()
+        self._dns_server, _ = await self._loop.create_datagram_endpoint(
+            lambda: _DNSServerProtocol(self),
+            local_addr=(self._dns_server_ip, self._port),
+            reuse_port=self._reuse_port or None)
+        self._tcp_server = await asyncio.start_server(
+            self._handle_tcp_client, self._dns_server_ip, self._port,
+            reuse_port=self._reuse_port or None)
+        try:
+            await self._stopped.wait()
+        finally:
+            self._dns_server.close()
+            self._tcp_server.close()
+            self._remote_dns_server.close()
+            for task in self._tasks:
+                task.cancel()
+
+    async def _handle_tcp_client(self, reader, writer):
+        def reply(response):
+            if not writer.is_closing():
+                writer.write(len(response).to_bytes(2, 'big') + response)
+
+        try:
             while True:
-                try:
-                    data, addr = self._dns_server.recvfrom(512)
-                    self._handle_request(data, addr)
-                except Exception as e:
-                    print(f"Error: {e}")
+                length = await asyncio.wait_for(reader.readexactly(2),
+                                                _TCP_IDLE_TIMEOUT)
+                data = await reader.readexactly(
+                    int.from_bytes(length, 'big'))
+                self._handle_request(data, reply)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
 
-    def _handle_request(self, data, addr):
+    def _reply_udp(self, query, addr, response):
+        if (len(response) > wire.UDP_PAYLOAD_SIZE
+                and len(response) > wire.udp_payload_size(query)):
+            response = wire.truncate(response, query)
+        self._dns_server.sendto(response, addr)
+
+    def _handle_request(self, data, reply):
+        self._requests.value += 1
         try:
-            query = DNSRecord.parse(data)
-            qname = str(query.q.qname)
-            qtype = query.q.qtype
+            question = wire.parse_question(data)
+            if question is None:
+                self._spawn(self._forward_request(data, reply, None))
+                return
+            qname = question.qname
+            qtype = question.qtype
 
-            if qtype == QTYPE.PTR and qname == "1.0.0.127.in-addr.arpa.":
+            local = self.local.answer(data, question)
+            if local is not None:
+                reply(local)
+                if self._should_log():
+                    _logger.info("event=local qname=%s qtype=%s",
+                                 qname, qtype)
                 return
 
             cached = self.cache.get(qname, qtype)
 
-            if cached:
-                print(f"Cache hit...")
-                response = self._build_response(query, cached)
-                print(response, '\n')
-                self._dns_server.sendto(response.pack(), addr)
+            if cached is not None:
+                now = time()
+                reply(cached.render(data, question.end, now))
+                cached.hits += 1
+                if ((qname, qtype) not in self._inflight
+                        and self._prefetcher.should_refresh(cached, now)):
+                    self._spawn(self._prefetch(data, question))
+                if self._should_log():
+                    _logger.info("event=hit qname=%s qtype=%s", qname, qtype)
                 return
 
-            print(f"Cache miss...")
-
-            try:
-                self._remote_dns_server.settimeout(5)
-                self._remote_dns_server.sendto(data, (
-                    self._remote_dns_server_ip, 53))
-                response_data, _ = self._remote_dns_server.recvfrom(512)
-                response = DNSRecord.parse(response_data)
+            if self._should_log():
+                _logger.info("event=miss qname=%s qtype=%s", qname, qtype)
+            self._spawn(self._forward_request(data, reply, question))
+        except Exception as e:
+            self._errors.inc()
+            _logger.warning("event=error error=%r", e)
 
-                print(response, '\n')
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-                if response.rr:
-                    ttl = response.rr[0].ttl
-                    self.cache.put(qname, qtype, response.rr, ttl)
-                self._dns_server.sendto(response_data, addr)
+    async def _forward_request(self, data, reply, question):
+        try:
+            if question is None:
+                response_data = await self._remote_dns_server.query(data)
+            else:
+                response_data = await self._inflight.do(
+                    (question.qname, question.qtype),
+                    lambda: self._resolve(data, question))
+            if response_data is None:
+                self._timeouts.inc()
+                if question is not None and self._should_log():
+                    _logger.info("event=timeout qname=%s qtype=%s",
+                                 question.qname, question.qtype)
+                return
+            reply(data[:2] + response_data[2:])
+        except Exception as e:
+            self._errors.inc()
+            _logger.warning("event=error error=%r", e)
 
-            except socket.timeout:
-                print(f"Timeout...")
+    async def _prefetch(self, data, question):
+        try:
+            await self._inflight.do(
+                (question.qname, question.qtype),
+                lambda: self._resolve(data, question, refresh=True))
         except Exception as e:
-            print(f"Error...")
+            self._errors.inc()
+            _logger.warning("event=prefetch_error error=%r", e)
+
+    async def _resolve(self, data, question, refresh=False):
+        if question.qtype != QTYPE.CNAME:
+            links, target = self._cached_chain(question.qname)
+            if links:
+                response_data = await self._resolve_chain(
+                    data, question, links, target, refresh)
+                if response_data is not None:
+                    return response_data
+        return await self._resolve_upstream(data, question)
+
+    def _cached_chain(self, qname):
+        # Follows cached CNAME RRsets from qname, returning them
+        # together with the name the chain ends at
+        links = []
+        name = qname
+        seen = {name}
+        while len(links) < _MAX_CHAIN:
+            link = self.cache.get(name, QTYPE.CNAME, count=False)
+            # A cached NODATA or NXDOMAIN for the CNAME query ends the
+            # chain like a missing entry
+            if link is None or not _is_positive(link.wire):
+                break
+            rr = DNSRecord.parse(link.wire).rr[0]
+            if rr.rtype != QTYPE.CNAME:
+                break
+            target = str(rr.rdata).lower()
+            if target in seen:
+                return [], qname
+            links.append(link)
+            seen.add(target)
+            name = target
+        return links, name
+
+    async def _resolve_chain(self, data, question, links, target, refresh):
+        # Only the RRset at the end of the chain is asked upstream, so
+        # names sharing a CDN target refresh it once between them.
+        final = None
+        if not refresh:
+            final = self.cache.get(target, question.qtype, count=False)
+            if final is not None and not _is_positive(final.wire):
+                # Negative answers come from the full query, which
+                # carries the SOA and rcode for the name asked
+                return None
+        if final is None:
+            target_query = bytes(DNSRecord(
+                q=DNSQuestion(target, question.qtype)).pack())
+            target_question = wire.parse_question(target_query)
+            response_data = await self._inflight.do(
+                (target, question.qtype),
+                lambda: self._resolve_upstream(target_query,
+                                               target_question))
+            if response_data is None or not _is_positive(response_data):
+                # Negative and odd answers come from the full query
+                return None
+            final = wire.CachedResponse.from_wire(response_data)
+
+        now = time()
+        response = DNSRecord.parse(data).reply(aa=0)
+        for entry in links + [final]:
+            response.add_answer(*DNSRecord.parse(bytes(entry.aged(now))).rr)
+        response_data = response.pack()
+        cached = wire.CachedResponse.from_wire(response_data, now)
+        if cached.min_ttl:
+            self.cache.put(question.qname, question.qtype,
+                           cached, cached.min_ttl)
+        if self._should_log():
+            _logger.info("event=chain qname=%s qtype=%s target=%s",
+                         question.qname, question.qtype, target)
+        return response_data
+
+    async def _resolve_upstream(self, data, question):
+        response_data = await self._remote_dns_server.query(data)
+        if response_data is None:
+            return None
+        header_flags = wire.flags(response_data)
+        rcode = header_flags & wire.RCODE_MASK
+        if self._should_log():
+            _logger.info("event=upstream qname=%s qtype=%s rcode=%s "
+                         "answers=%s size=%s",
+                         question.qname, question.qtype, rcode,
+                         wire.answer_count(response_data), len(response_data))
+        if header_flags & wire.FLAG_TC:
+            return response_data
+        if rcode == RCODE.NOERROR and wire.answer_count(response_data):
+            cached = wire.CachedResponse.from_wire(response_data)
+            self.cache.put(question.qname, question.qtype,
+                           cached, cached.min_ttl)
+            self._cache_rrsets(DNSRecord.parse(response_data), question)
+        elif rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            ttl = self._negative_ttl_of(DNSRecord.parse(response_data))
+            if ttl is not None:
+                cached = wire.CachedResponse.from_wire(response_data,
+                                                       max_ttl=ttl)
+                self.cache.put(question.qname, question.qtype, cached, ttl)
+        return response_data
+
+    def _cache_rrsets(self, response, question):
+        # Each RRset of the CNAME chain is cached under its own owner
+        # and type with its own TTL. RRsets off the chain are ignored,
+        # an upstream has no say over unrelated names.
+        rrsets = {}
+        for rr in response.rr:
+            key = (str(rr.rname).lower(), rr.rtype)
+            rrsets.setdefault(key, []).append(rr)
+        name = question.qname
+        seen = {name}
+        while (name, QTYPE.CNAME) in rrsets and len(seen) <= _MAX_CHAIN:
+            self._put_rrset(name, QTYPE.CNAME, rrsets[(name, QTYPE.CNAME)])
+            name = str(rrsets[(name, QTYPE.CNAME)][0].rdata).lower()
+            if name in seen:
+                return
+            seen.add(name)
+        if name != question.qname and (name, question.qtype) in rrsets:
+            self._put_rrset(name, question.qtype,
+                            rrsets[(name, question.qtype)])
+
+    def _put_rrset(self, owner, rtype, rrs):
+        message = DNSRecord(DNSHeader(qr=1, rd=1, ra=1),
+                           q=DNSQuestion(owner, rtype), rr=rrs)
+        cached = wire.CachedResponse.from_wire(message.pack())
+        if cached.min_ttl:
+            self.cache.put(owner, rtype, cached, cached.min_ttl)
+
+    def _negative_ttl_of(self, response):
+        # RFC 2308: NXDOMAIN/NODATA is cached for min(SOA TTL, SOA MINIMUM)
+        for rr in response.auth:
+            if rr.rtype == QTYPE.SOA:
+                return min(rr.ttl, rr.rdata.times[-1], self._negative_ttl)
+        return None
+
+
+def _is_positive(data: bytes) -> bool:
+    # A NOERROR answer with records, not truncated
+    return (not wire.flags(data) & (wire.RCODE_MASK | wire.FLAG_TC)
+            and wire.answer_count(data) > 0)
+
+
+class _DNSServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: DNSServer):
+        self._server = server
+
+    def datagram_received(self, data, addr):
+        self._server._handle_request(
+            data,
+            lambda response: self._server._reply_udp(data, addr, response))
 
-    def _build_response(self, query, records):
-        response = query.reply()
-        for rr in records:
-            response.add_answer(rr)
-        return response
+    def error_received(self, exc):
+        _logger.warning("event=socket_error error=%r", exc)
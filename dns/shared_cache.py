@@ -0,0 +1,280 @@
+import multiprocessing
+import os
+import struct
+import zlib
+from multiprocessing import shared_memory
+from time import time
+from typing import Iterator
+
+from dns.journal import CacheJournal
+from dns.wire import CachedResponse
+
+DEFAULT_SLOT_SIZE = 1024
+DEFAULT_LOCK_STRIPES = 64
+
+# key hash, expire_time, stored_at, last_used, hits, qtype, question_end,
+# qname length, wire length, number of TTL fields
+_SLOT = struct.Struct(">IdddIHHHHH")
+_USAGE = struct.Struct(">dI")
+_USAGE_OFFSET = 20
+_COUNTER = struct.Struct(">q")
+_HITS, _MISSES, _EVICTIONS, _EXPIRATIONS, _ENTRIES, _BYTES = range(6)
+_COUNTERS = 6
+_TTL_ITEM = struct.Struct(">HI")
+# Each key may live in one of this many slots of its set
+_WAYS = 8
+# Expire time of a slot whose expiry has been counted: not empty, so
+# probing goes on past it, and free for reuse
+_RECLAIMED = 1.0
+# Sets checked for expired entries per stats() call
+_SWEEP_SETS = 256
+_EXPIRE = struct.Struct(">d")
+_EXPIRE_OFFSET = 4
+
+
+# A DNSCache-compatible table in shared memory, inherited by forked
+# worker processes. It is set-associative: a key hashes to one set of
+# _WAYS fixed-size slots and only ever lives there, so a lookup probes at
+# most _WAYS slots under the set's striped lock. Slots are overwritten but
+# never cleared, so probing can stop at the first empty slot. Counters are
+# kept per lock stripe in the shared block and updated under that lock;
+# the entry and byte counts drop when an expired entry is noticed by a
+# lookup, by the bounded sweep in stats() or when its slot is reused.
+class SharedDNSCache:
+    def __init__(self, max_entries, max_bytes, slot_size=DEFAULT_SLOT_SIZE,
+                 lock_stripes=DEFAULT_LOCK_STRIPES, file=None):
+        slots = max(_WAYS, min(max_entries, max_bytes // slot_size))
+        self._sets = slots // _WAYS
+        self._slot_size = slot_size
+        self._counters_size = lock_stripes * _COUNTERS * _COUNTER.size
+        # New POSIX shared memory is zero-filled, i.e. all slots are empty
+        self._shm = shared_memory.SharedMemory(
+            create=True,
+            size=self._counters_size + self._sets * _WAYS * slot_size)
+        self._locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+        self._owner_pid = os.getpid()
+        self._journal = CacheJournal(file) if file is not None else None
+        self.oversized = 0
+        self._sweep_cursor = 0
+        self._load_cache()
+
+    def __len__(self):
+        return self.stats()['entries']
+
+    def get(self, qname, qtype, count=True):
+        name = qname.encode()
+        key_hash = _hash(name, qtype)
+        set_index = key_hash % self._sets
+        buf = self._shm.buf
+        with self._lock(set_index):
+            offset = self._find(buf, set_index, key_hash, name, qtype)
+            if offset is None:
+                if count:
+                    self._count(buf, set_index, _MISSES)
+                return None
+            (_, expire_time, stored_at, _, hits, _, question_end,
+             name_length, wire_length, ttl_count) = _SLOT.unpack_from(
+                buf, offset)
+            now = time()
+            if now > expire_time:
+                if expire_time != _RECLAIMED:
+                    self._reclaim(buf, set_index, offset, wire_length)
+                if count:
+                    self._count(buf, set_index, _MISSES)
+                return None
+            if count:
+                self._count(buf, set_index, _HITS)
+            _USAGE.pack_into(buf, offset + _USAGE_OFFSET, now, hits + 1)
+            wire_start = offset + _SLOT.size + name_length
+            wire_end = wire_start + wire_length
+            wire = bytes(buf[wire_start:wire_end])
+            ttls = list(_TTL_ITEM.iter_unpack(
+                buf[wire_end:wire_end + ttl_count * _TTL_ITEM.size]))
+        return CachedResponse(wire, question_end, ttls, stored_at, hits + 1)
+
+    def put(self, qname, qtype, records, ttl):
+        self._store(qname, qtype, time() + ttl, records)
+
+    def stats(self):
+        self._sweep(_SWEEP_SETS)
+        buf = self._shm.buf
+        totals = [0] * _COUNTERS
+        for offset in range(0, self._counters_size, _COUNTER.size):
+            totals[offset // _COUNTER.size % _COUNTERS] += \
+                _COUNTER.unpack_from(buf, offset)[0]
+        return {
+            'entries': totals[_ENTRIES],
+            'bytes': totals[_BYTES],
+            'hits': totals[_HITS],
+            'misses': totals[_MISSES],
+            'evictions': totals[_EVICTIONS],
+            'expirations': totals[_EXPIRATIONS],
+        }
+
+    def _sweep(self, sets):
+        # Counts the expiry of entries in the next few sets, so entries
+        # nobody asks for again leave the entry and byte counts too
+        now = time()
+        buf = self._shm.buf
+        for _ in range(min(sets, self._sets)):
+            set_index = self._sweep_cursor
+            self._sweep_cursor = (set_index + 1) % self._sets
+            base = set_index * _WAYS
+            with self._lock(set_index):
+                for way in range(_WAYS):
+                    offset = self._slot_offset(base + way)
+                    (_, expire_time, _, _, _, _, _, _, wire_length,
+                     _) = _SLOT.unpack_from(buf, offset)
+                    if expire_time == 0:
+                        break
+                    if _RECLAIMED < expire_time < now:
+                        self._reclaim(buf, set_index, offset, wire_length)
+
+    def items(self) -> Iterator[tuple[tuple[str, int], float,
+                                      CachedResponse]]:
+        now = time()
+        buf = self._shm.buf
+        for slot in range(self._sets * _WAYS):
+            offset = self._slot_offset(slot)
+            with self._lock(slot // _WAYS):
+                (_, expire_time, stored_at, _, hits, qtype, question_end,
+                 name_length, wire_length, ttl_count) = _SLOT.unpack_from(
+                    buf, offset)
+                if expire_time < now:
+                    continue
+                name_start = offset + _SLOT.size
+                wire_start = name_start + name_length
+                wire_end = wire_start + wire_length
+                qname = bytes(buf[name_start:wire_start]).decode()
+                wire = bytes(buf[wire_start:wire_end])
+                ttls = list(_TTL_ITEM.iter_unpack(
+                    buf[wire_end:wire_end + ttl_count * _TTL_ITEM.size]))
+            yield ((qname, qtype), expire_time,
+                   CachedResponse(wire, question_end, ttls, stored_at, hits))
+
+    def save_cache(self):
+        if self._journal is None:
+            return
+        try:
+            self._journal.begin_compaction()
+            count = self._journal.write_snapshot(self.items())
+            self._journal.finish_compaction(count)
+            self._journal.flush(sync=True)
+            print("Cache was saved")
+        except Exception as e:
+            print(f"Couldn't save cache: {e}")
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+
+    def _load_cache(self):
+        if self._journal is None:
+            return
+        try:
+            for (qname, qtype), expire_time, records in \
+                    self._journal.load(time()):
+                self._store(qname, qtype, expire_time, records)
+            print("Cache was loaded")
+        except Exception as e:
+            print(f"Couldn't load cache, persistence disabled: {e}")
+            self._journal = None
+
+    def _store(self, qname, qtype, expire_time, records):
+        name = qname.encode()
+        ttl_count = len(records.ttls)
+        if (_SLOT.size + len(name) + len(records.wire)
+                + ttl_count * _TTL_ITEM.size > self._slot_size):
+            self.oversized += 1
+            return
+        key_hash = _hash(name, qtype)
+        set_index = key_hash % self._sets
+        buf = self._shm.buf
+        now = time()
+        with self._lock(set_index):
+            offset = self._find(buf, set_index, key_hash, name, qtype)
+            if offset is None:
+                offset = self._victim(buf, set_index, now)
+            (_, old_expire, _, _, _, _, _, _, old_length,
+             _) = _SLOT.unpack_from(buf, offset)
+            if old_expire > _RECLAIMED:
+                # A live entry, or an expired one not counted yet
+                if old_expire < now:
+                    self._count(buf, set_index, _EXPIRATIONS)
+                self._count(buf, set_index, _ENTRIES, -1)
+                self._count(buf, set_index, _BYTES, -old_length)
+            self._count(buf, set_index, _ENTRIES)
+            self._count(buf, set_index, _BYTES, len(records.wire))
+            _SLOT.pack_into(buf, offset, key_hash, expire_time,
+                            records.stored_at, now, 0, qtype,
+                            records.question_end, len(name),
+                            len(records.wire), ttl_count)
+            position = offset + _SLOT.size
+            buf[position:position + len(name)] = name
+            position += len(name)
+            buf[position:position + len(records.wire)] = records.wire
+            position += len(records.wire)
+            for ttl_offset, ttl in records.ttls:
+                _TTL_ITEM.pack_into(buf, position, ttl_offset, ttl)
+                position += _TTL_ITEM.size
+
+    def _find(self, buf, set_index, key_hash, name, qtype):
+        base = set_index * _WAYS
+        for way in range(_WAYS):
+            offset = self._slot_offset(base + way)
+            (slot_hash, expire_time, _, _, _, slot_qtype, _, name_length,
+             _, _) = _SLOT.unpack_from(buf, offset)
+            if expire_time == 0:
+                return None
+            if (slot_hash != key_hash or slot_qtype != qtype
+                    or name_length != len(name)):
+                continue
+            name_start = offset + _SLOT.size
+            if buf[name_start:name_start + name_length] == name:
+                return offset
+        return None
+
+    def _victim(self, buf, set_index, now):
+        # First free slot, else an expired one, else the least recently used
+        base = set_index * _WAYS
+        victim = None
+        victim_used = None
+        for way in range(_WAYS):
+            offset = self._slot_offset(base + way)
+            (_, expire_time, _, last_used, _, _, _, _, _,
+             _) = _SLOT.unpack_from(buf, offset)
+            if expire_time == 0 or expire_time < now:
+                return offset
+            if victim_used is None or last_used < victim_used:
+                victim, victim_used = offset, last_used
+        self._count(buf, set_index, _EVICTIONS)
+        return victim
+
+    def _slot_offset(self, slot):
+        return self._counters_size + slot * self._slot_size
+
+    def _lock(self, set_index):
+        return self._locks[set_index % len(self._locks)]
+
+    def _reclaim(self, buf, set_index, offset, wire_length):
+        # Counts the expiry of the entry at offset, with its set's lock
+        # held
+        _EXPIRE.pack_into(buf, offset + _EXPIRE_OFFSET, _RECLAIMED)
+        self._count(buf, set_index, _EXPIRATIONS)
+        self._count(buf, set_index, _ENTRIES, -1)
+        self._count(buf, set_index, _BYTES, -wire_length)
+
+    def _count(self, buf, set_index, counter, amount=1):
+        # Only called with the set's lock held, which owns these counters
+        offset = ((set_index % len(self._locks)) * _COUNTERS + counter) \
+            * _COUNTER.size
+        _COUNTER.pack_into(buf, offset,
+                           _COUNTER.unpack_from(buf, offset)[0] + amount)
+
+
+def _hash(name: bytes, qtype: int) -> int:
+    # Stable across processes, unlike the randomized built-in hash()
+    return zlib.crc32(struct.pack(">H", qtype), zlib.crc32(name))
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import random
+import struct
+from collections import deque
+from time import monotonic
+
+from dns import wire
+from dns.metrics import Histogram, MetricsRegistry
+
+DEFAULT_PORT = 53
+DEFAULT_HEDGE_PERCENTILE = 0.95
+
+# Smoothed RTT gains as in TCP (RFC 6298)
+_ALPHA = 1 / 8
+_BETA = 1 / 4
+_RTT_SAMPLES = 128
+_MIN_HEDGE_SAMPLES = 8
+# Upstreams with this many consecutive timeouts are skipped
+# until the backoff passes, then probed again.
+_MAX_FAILURES = 3
+_FAILURE_BACKOFF = 30
+
+_logger = logging.getLogger('dns.upstream')
+
+
+class UpstreamResolver:
+    def __init__(self, address: tuple[str, int], timeout: float = 5,
+                 rtt_histogram: Histogram | None = None):
+        self.address = address
+        self._timeout = timeout
+        self._rtt_histogram = rtt_histogram
+        # Outstanding queries by transaction ID, with the question they
+        # asked: a reply must echo both to be taken as the answer
+        self._pending: dict[int, tuple[tuple | None, asyncio.Future]] = {}
+        self._transport: asyncio.DatagramTransport | None = None
+
+        self._tcp_writer: asyncio.StreamWriter | None = None
+        self._tcp_reader_task: asyncio.Task | None = None
+        self._tcp_lock: asyncio.Lock | None = None
+
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.failures = 0
+        self._last_failure = 0.0
+        self._samples = deque(maxlen=_RTT_SAMPLES)
+
+        self.queries = 0
+        self.timeouts = 0
+        self.tcp_queries = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._tcp_lock = asyncio.Lock()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UpstreamProtocol(self),
+            remote_addr=self.address)
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+        self._close_tcp()
+        for _, future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+
+    @property
+    def healthy(self) -> bool:
+        return (self.failures < _MAX_FAILURES
+                or monotonic() - self._last_failure > _FAILURE_BACKOFF)
+
+    def hedge_delay(self, percentile: float) -> float:
+        if len(self._samples) < _MIN_HEDGE_SAMPLES:
+            return max(self.srtt + 4 * self.rttvar, 0.05)
+        samples = sorted(self._samples)
+        return samples[int(percentile * (len(samples) - 1))]
+
+    async def query(self, data: bytes,
+                    timeout: float | None = None) -> bytes | None:
+        if len(data) < wire.HEADER.size:
+            return None
+        timeout = self._timeout if timeout is None else timeout
+        self.queries += 1
+        started = monotonic()
+        txid, future = self._register(data)
+        try:
+            self._transport.sendto(struct.pack(">H", txid) + data[2:])
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._on_timeout(timeout)
+            return None
+        except asyncio.CancelledError:
+            # A query that lost a hedge race still says the RTT is
+            # at least this long, otherwise a slow upstream stays ranked
+            # by its last good sample.
+            elapsed = monotonic() - started
+            if elapsed > self.srtt:
+                self._on_rtt(elapsed)
+            raise
+        finally:
+            self._pending.pop(txid, None)
+        self.failures = 0
+        self._on_rtt(monotonic() - started)
+
+        if wire.flags(response) & wire.FLAG_TC:
+            response = await self._query_tcp(data, timeout)
+            if response is None:
+                return None
+        return data[:2] + response[2:]
+
+    async def _query_tcp(self, data: bytes, timeout: float) -> bytes | None:
+        self.tcp_queries += 1
+        txid, future = self._register(data)
+        try:
+            message = struct.pack(">H", txid) + data[2:]
+            # A pooled connection may have been closed by the upstream
+            # while idle, so a failed write is retried on a fresh one.
+            for _ in range(2):
+                writer = await self._tcp_connection(timeout)
+                try:
+                    writer.write(struct.pack(">H", len(message)) + message)
+                    await writer.drain()
+                    break
+                except ConnectionError:
+                    self._close_tcp()
+            else:
+                return None
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
+            self._on_timeout(timeout)
+            return None
+        finally:
+            self._pending.pop(txid, None)
+
+    async def _tcp_connection(self, timeout: float) -> asyncio.StreamWriter:
+        async with self._tcp_lock:
+            if self._tcp_writer is None or self._tcp_writer.is_closing():
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.address), timeout)
+                self._tcp_writer = writer
+                self._tcp_reader_task = asyncio.create_task(
+                    self._read_tcp(reader, writer))
+            return self._tcp_writer
+
+    async def _read_tcp(self, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length, = struct.unpack(">H", await reader.readexactly(2))
+                self._on_response(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+            if self._tcp_writer is writer:
+                self._tcp_writer = None
+
+    def _close_tcp(self):
+        if self._tcp_writer is not None:
+            self._tcp_writer.close()
+            self._tcp_writer = None
+        if self._tcp_reader_task is not None:
+            self._tcp_reader_task.cancel()
+            self._tcp_reader_task = None
+
+    def _register(self, data: bytes) -> tuple[int, asyncio.Future]:
+        txid = self._allocate_id()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[txid] = (_question_key(data), future)
+        return txid, future
+
+    def _allocate_id(self) -> int:
+        if len(self._pending) >= 0x10000:
+            raise RuntimeError("Too many outstanding upstream queries")
+        while True:
+            txid = random.randrange(0x10000)
+            if txid not in self._pending:
+                return txid
+
+    def _on_response(self, data: bytes):
+        if len(data) < wire.HEADER.size:
+            return
+        txid, = struct.unpack_from(">H", data)
+        pending = self._pending.get(txid)
+        if pending is None:
+            return
+        question, future = pending
+        # A late reply to a timed out query whose ID has been reused,
+        # or a spoofed one, asks a different question
+        if future.done() or _question_key(data) != question:
+            return
+        future.set_result(data)
+
+    def _on_rtt(self, rtt: float):
+        if self._rtt_histogram is not None:
+            self._rtt_histogram.observe(rtt)
+        self._samples.append(rtt)
+        if not self.srtt:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += _BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += _ALPHA * (rtt - self.srtt)
+
+    def _on_timeout(self, timeout: float):
+        self.timeouts += 1
+        self.failures += 1
+        self._last_failure = monotonic()
+        self.srtt = min(max(self.srtt * 2, timeout / 2), timeout)
+
+
+class UpstreamPool:
+    def __init__(self, addresses: list[tuple[str, int]],
+                 timeout: float = 5,
+                 hedge: bool = False,
+                 hedge_percentile: float = DEFAULT_HEDGE_PERCENTILE,
+                 metrics: MetricsRegistry | None = None):
+        self.upstreams = []
+        for host, port in addresses:
+            histogram = None
+            if metrics is not None:
+                histogram = metrics.histogram(
+                    f'dns_upstream_rtt_seconds{{upstream="{host}:{port}"}}')
+            self.upstreams.append(
+                UpstreamResolver((host, port), timeout, histogram))
+        self._timeout = timeout
+        self._hedge = hedge
+        self._hedge_percentile = hedge_percentile
+        self.hedged = 0
+
+    async def start(self):
+        for upstream in self.upstreams:
+            await upstream.start()
+
+    def close(self):
+        for upstream in self.upstreams:
+            upstream.close()
+
+    async def query(self, data: bytes) -> bytes | None:
+        ranked = self._rank()
+        primary = ranked[0]
+        pending = {asyncio.ensure_future(primary.query(data))}
+        try:
+            delay = primary.hedge_delay(self._hedge_percentile)
+            if self._hedge and len(ranked) > 1 and delay < self._timeout:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    self.hedged += 1
+                    pending.add(asyncio.ensure_future(
+                        ranked[1].query(data, self._timeout - delay)))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if response is not None:
+                        return response
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _rank(self) -> list[UpstreamResolver]:
+        healthy = [u for u in self.upstreams if u.healthy]
+        return sorted(healthy or self.upstreams, key=lambda u: u.srtt)
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver: UpstreamResolver):
+        self._resolver = resolver
+
+    def datagram_received(self, data, addr):
+        self._resolver._on_response(data)
+
+    def error_received(self, exc):
+        _logger.warning("event=upstream_error upstream=%s:%s error=%r",
+                        *self._resolver.address, exc)
+
+
+def _question_key(data: bytes) -> tuple | None:
+    question = wire.parse_question(data)
+    if question is None:
+        return None
+    return question.qname, question.qtype, question.qclass
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    if value.startswith('['):
+        host, _, port = value[1:].partition(']')
+        return host, int(port.lstrip(':') or DEFAULT_PORT)
+    if value.count(':') != 1:
+        return value, DEFAULT_PORT
+    host, _, port = value.partition(':')
+    return host, int(port)
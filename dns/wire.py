@@ -0,0 +1,153 @@
+import struct
+from dataclasses import dataclass
+from time import time
+
+HEADER = struct.Struct(">HHHHHH")
+_RR = struct.Struct(">HHIH")
+_TTL = struct.Struct(">I")
+
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000F
+TYPE_OPT = 41
+UDP_PAYLOAD_SIZE = 512
+
+
+@dataclass
+class Question:
+    qname: str
+    qtype: int
+    qclass: int
+    end: int
+
+
+def parse_question(data: bytes) -> Question | None:
+    try:
+        if len(data) < HEADER.size:
+            return None
+        qdcount, = struct.unpack_from(">H", data, 4)
+        if qdcount != 1:
+            return None
+        labels = []
+        offset = HEADER.size
+        while True:
+            length = data[offset]
+            if length == 0:
+                offset += 1
+                break
+            if length & 0xC0:
+                return None
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        qtype, qclass = struct.unpack_from(">HH", data, offset)
+        qname = (b'.'.join(labels) + b'.').decode('ascii', 'replace')
+        return Question(qname.lower(), qtype, qclass, offset + 4)
+    except (IndexError, struct.error):
+        return None
+
+
+def skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError("Bad label type")
+        offset += 1 + length
+
+
+def ttl_offsets(data: bytes) -> tuple[int, list[tuple[int, int]]]:
+    qdcount, ancount, nscount, arcount = struct.unpack_from(">HHHH", data, 4)
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+    question_end = offset
+
+    ttls = []
+    for _ in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, rdlength = _RR.unpack_from(data, offset)
+        # The OPT pseudo-record keeps EDNS flags in its TTL field
+        if rtype != TYPE_OPT:
+            ttls.append((offset + 4, ttl))
+        offset += _RR.size + rdlength
+    if offset > len(data):
+        raise ValueError("Truncated message")
+    return question_end, ttls
+
+
+def udp_payload_size(query: bytes) -> int:
+    # Clients advertise a larger UDP limit in the class of an EDNS OPT RR
+    try:
+        _, ancount, nscount, arcount = struct.unpack_from(">HHHH", query, 4)
+        question_end, _ = ttl_offsets(query)
+        offset = question_end
+        for index in range(ancount + nscount + arcount):
+            offset = skip_name(query, offset)
+            rtype, rclass, _, rdlength = _RR.unpack_from(query, offset)
+            if rtype == TYPE_OPT and index >= ancount + nscount:
+                return max(rclass, UDP_PAYLOAD_SIZE)
+            offset += _RR.size + rdlength
+    except (IndexError, ValueError, struct.error):
+        pass
+    return UDP_PAYLOAD_SIZE
+
+
+def truncate(response: bytes, query: bytes) -> bytes:
+    question_end, _ = ttl_offsets(query)
+    txid, response_flags = struct.unpack_from(">HH", response)
+    return (HEADER.pack(txid, response_flags | FLAG_TC, 1, 0, 0, 0)
+            + query[HEADER.size:question_end])
+
+
+def flags(data: bytes) -> int:
+    return struct.unpack_from(">H", data, 2)[0]
+
+
+def answer_count(data: bytes) -> int:
+    return struct.unpack_from(">H", data, 6)[0]
+
+
+@dataclass
+class CachedResponse:
+    wire: bytes
+    question_end: int
+    ttls: list[tuple[int, int]]
+    stored_at: float
+    hits: int = 0
+
+    @classmethod
+    def from_wire(cls, data: bytes, now: float | None = None,
+                  max_ttl: int | None = None):
+        question_end, ttls = ttl_offsets(data)
+        if max_ttl is not None:
+            ttls = [(offset, min(ttl, max_ttl)) for offset, ttl in ttls]
+        return cls(bytes(data), question_end, ttls,
+                   time() if now is None else now)
+
+    @property
+    def size(self) -> int:
+        return len(self.wire) + 16 * len(self.ttls)
+
+    @property
+    def min_ttl(self) -> int:
+        return min((ttl for _, ttl in self.ttls), default=0)
+
+    def render(self, query: bytes, question_end: int,
+               now: float | None = None) -> bytes:
+        response = self.aged(now)
+        response[0:2] = query[0:2]
+        if question_end == self.question_end:
+            # Echo the client's question so 0x20 letter casing survives
+            response[HEADER.size:question_end] = \
+                query[HEADER.size:question_end]
+        return bytes(response)
+
+    def aged(self, now: float | None = None) -> bytearray:
+        # The stored message with TTLs counted down to now
+        response = bytearray(self.wire)
+        elapsed = int((time() if now is None else now) - self.stored_at)
+        for offset, ttl in self.ttls:
+            _TTL.pack_into(response, offset, max(ttl - elapsed, 0))
+        return response
@@ -1,10 +1,16 @@
+import asyncio
+import csv
 import enum
+import json
+import sys
 
 import argparse
-import ipaddress
-from ipaddress import IPv4Address
+from ipaddress import IPv4Address, IPv4Network
 from tabulate import tabulate
-from ports.detector import DetectionResult, ProtocolDetector
+from ports.detector import Detection, DetectionResult, ProtocolDetector
+from ports.state import ScanState
+from ports.timing import DEFAULT_PROFILE, PROFILES
+from ports.targets import pairs, parse_ports, parse_targets
 
 
 class Protocol(enum.StrEnum):
@@ -12,26 +18,89 @@ class Protocol(enum.StrEnum):
     UDP = "udp"
 
 
-def _main(args: argparse.Namespace):
+class OutputFormat(enum.StrEnum):
+    TABLE = "table"
+    JSONL = "jsonl"
+    CSV = "csv"
+
+
+def _targets(args: argparse.Namespace
+             ) -> tuple[list[IPv4Network], list[range]]:
     try:
-        dest: IPv4Address = IPv4Address(args.ip)
-    except ipaddress.AddressValueError:
-        parser.error("Invalid IPv4 address.")
-    start: int = args.port_start
-    end: int = args.port_end
+        networks = parse_targets(args.targets)
+        if args.ports is not None:
+            if args.port_start is not None:
+                parser.error("Use either --ports or a port range.")
+            ports = parse_ports(args.ports)
+        elif args.port_start is not None and args.port_end is not None:
+            ports = [range(args.port_start, args.port_end)]
+        else:
+            parser.error("No ports to scan.")
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return networks, ports
 
-    protocol_detector = ProtocolDetector(args.timeout)
-    protocols: dict[int, DetectionResult] = {}
 
+async def _scan(args: argparse.Namespace, output):
+    protocol_detector = ProtocolDetector(args.timeout, args.concurrency,
+                                         args.timing)
     if args.protocol == Protocol.TCP:
-        protocols = protocol_detector.detect_tcp_protocols(dest, start, end)
-    elif args.protocol == Protocol.UDP:
-        protocols = protocol_detector.detect_udp_protocols(dest, start, end)
-    
-    result = [(port, protocol.name) for port, protocol in protocols.items()]
-    t: str = tabulate(sorted(result, key=lambda x: x[0]),
-                      headers=["port", "protocol"])
-    print(t)
+        stream = protocol_detector.stream_tcp_protocols
+    else:
+        stream = protocol_detector.stream_udp_protocols
+    networks, ports = _targets(args)
+    if args.state is None:
+        async for detection in stream(pairs(networks, ports)):
+            output(detection)
+        return
+
+    state = ScanState(args.state)
+    session = state.session(args.protocol, networks, ports,
+                            args.incremental, args.max_age * 3600)
+    try:
+        for detection in session.previous():
+            output(detection)
+        async for detection in stream(session.targets(), closed=True):
+            session.record(detection)
+            if detection[2] != DetectionResult.CLOSED:
+                output(detection)
+        session.finish()
+    finally:
+        # Also on Ctrl+C, so the next run resumes from here
+        session.checkpoint()
+        state.close()
+
+
+def _main(args: argparse.Namespace):
+    if args.format == OutputFormat.TABLE:
+        # A table needs every row before it can be printed
+        found: list[Detection] = []
+        asyncio.run(_scan(args, found.append))
+        result = [(str(ip), port, protocol.name)
+                  for ip, port, protocol in found]
+        t: str = tabulate(sorted(result, key=lambda x: (IPv4Address(x[0]),
+                                                        x[1])),
+                          headers=["ip", "port", "protocol"])
+        print(t)
+        return
+
+    writer = csv.writer(sys.stdout)
+
+    def write(detection: Detection):
+        ip, port, protocol = detection
+        if args.format == OutputFormat.JSONL:
+            print(json.dumps({"ip": str(ip), "port": port,
+                              "protocol": protocol.name}), flush=True)
+        else:
+            writer.writerow([ip, port, protocol.name])
+            sys.stdout.flush()
+
+    if args.format == OutputFormat.CSV:
+        writer.writerow(["ip", "port", "protocol"])
+    try:
+        asyncio.run(_scan(args, write))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -45,24 +114,75 @@ if __name__ == "__main__":
         help="Protocol to use"
     )
     parser.add_argument(
-        "ip",
+        "targets",
         type=str,
-        help="Input IPv4 address"
+        help="IPv4 addresses, CIDR ranges and host names separated "
+             "by commas; @file reads them from a file"
     )
     parser.add_argument(
         "port_start",
         type=int,
+        nargs="?",
         help="Port range lower bound"
     )
     parser.add_argument(
         "port_end",
         type=int,
+        nargs="?",
         help="Port range upper bound (non-inclusive)"
     )
+    parser.add_argument(
+        "--ports", "-p",
+        type=str,
+        help="Ports to scan instead of a range, e.g. 22,80,8000-8100"
+    )
+    parser.add_argument(
+        "--format", "-f",
+        type=str,
+        choices=[str(output) for output in OutputFormat],
+        default=OutputFormat.TABLE,
+        help="table waits for the whole scan, jsonl and csv print "
+             "results as they are found"
+    )
+    parser.add_argument(
+        "--timing", "-T",
+        type=str,
+        choices=list(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="Timing profile: timeouts, retries and concurrency bounds"
+    )
     parser.add_argument(
         "--timeout", "-t",
         type=float,
-        default=0.5,
-        help="How long to wait for a reply"
+        help="Timeout before the RTT to a host is known, and for "
+             "protocol replies (default: from the timing profile)"
+    )
+    parser.add_argument(
+        "--concurrency", "-c",
+        type=int,
+        help="Upper bound on probes in flight "
+             "(default: from the timing profile)"
+    )
+    parser.add_argument(
+        "--state", "-s",
+        type=str,
+        help="SQLite file with scan results and checkpoints; "
+             "an interrupted scan of the same targets resumes"
+    )
+    parser.add_argument(
+        "--incremental", "-i",
+        action="store_true",
+        help="With --state: probe known open ports first and skip "
+             "ports a recent scan found closed"
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=7 * 24,
+        help="Hours a scan's closed ports stay fresh for --incremental "
+             "(default: a week)"
     )
-    _main(parser.parse_args())
+    args = parser.parse_args()
+    if args.incremental and args.state is None:
+        parser.error("--incremental needs --state.")
+    _main(args)
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import os
+from ipaddress import IPv4Address
+from time import monotonic
+from typing import AsyncIterator
+
+from ports.bench.services import (TCP_SERVICES, UDP_SERVICES, ServiceFarm,
+                                  make_plan)
+from ports.detector import DetectionResult, ProtocolDetector
+from ports.scanner import PortScanner, PortState
+from ports.targets import parse_ports
+from ports.timing import DEFAULT_PROFILE, PROFILES
+
+_SAMPLE_INTERVAL = 0.05
+# Mismatches listed in the report, the rest are only counted
+_MAX_ERRORS = 10
+
+
+class _Usage:
+    # Peak descriptors, threads and resident memory of this process,
+    # sampled while a phase runs
+    def __init__(self):
+        self.fds = 0
+        self.threads = 0
+        self.rss = 0
+
+    def sample(self):
+        self.fds = max(self.fds, len(os.listdir('/proc/self/fd')))
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    self.rss = max(self.rss, int(line.split()[1]) * 1024)
+                elif line.startswith('Threads:'):
+                    self.threads = max(self.threads, int(line.split()[1]))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(_SAMPLE_INTERVAL)
+
+
+async def _phase(name: str, results: AsyncIterator[tuple[int, object]],
+                 expected: dict[int, object], default: object,
+                 ports: list[int]) -> dict:
+    usage = _Usage()
+    sampler = asyncio.create_task(usage.run())
+    started = monotonic()
+    found = {port: result async for port, result in results}
+    elapsed = monotonic() - started
+    sampler.cancel()
+    usage.sample()
+
+    errors = []
+    for port in ports:
+        want = expected.get(port, default)
+        got = found.get(port, default)
+        if got != want:
+            errors.append(f"{port}: expected {want.name}, got {got.name}")
+    return {
+        'phase': name,
+        'ports': len(ports),
+        'elapsed_s': round(elapsed, 3),
+        'ports_per_s': round(len(ports) / elapsed, 1),
+        'correct': len(ports) - len(errors),
+        'accuracy': round(1 - len(errors) / len(ports), 4),
+        'errors': errors[:_MAX_ERRORS],
+        'fds_peak': usage.fds,
+        'threads_peak': usage.threads,
+        'rss_peak_mib': round(usage.rss / 1024 / 1024, 1),
+    }
+
+
+async def _bench(args: argparse.Namespace, farm: ServiceFarm,
+                 ports: list[int]) -> list[dict]:
+    ip = IPv4Address(args.address)
+    targets = [(ip, port) for port in ports]
+    tcp = {port: kind for port, kind in farm.tcp.items()
+           if ('tcp', port) not in farm.failed}
+    udp = {port: kind for port, kind in farm.udp.items()
+           if ('udp', port) not in farm.failed}
+    scanner = lambda: PortScanner(args.timeout, args.concurrency, args.timing)
+    detector = lambda: ProtocolDetector(args.timeout, args.concurrency,
+                                        args.timing)
+    phases = []
+
+    async def ports_only(stream):
+        async for _, port in stream:
+            yield port, PortState.OPEN
+
+    async def states(stream):
+        async for _, port, state in stream:
+            yield port, state
+
+    async def detections(stream):
+        async for _, port, result in stream:
+            yield port, result
+
+    if args.protocol in ('tcp', 'both'):
+        phases.append(await _phase(
+            'tcp_scan', ports_only(scanner().stream_tcp_ports(targets)),
+            dict.fromkeys(tcp, PortState.OPEN), PortState.CLOSED, ports))
+        phases.append(await _phase(
+            'tcp_detect',
+            detections(detector().stream_tcp_protocols(targets)),
+            {port: TCP_SERVICES[kind] for port, kind in tcp.items()},
+            DetectionResult.CLOSED, ports))
+    if args.protocol in ('udp', 'both'):
+        # The scanner's empty probe is not a valid DNS or SNTP request,
+        # so like real servers the stand-ins let it go unanswered
+        phases.append(await _phase(
+            'udp_scan', states(scanner().stream_udp_port_states(targets)),
+            dict.fromkeys(udp, PortState.OPEN_FILTERED),
+            PortState.CLOSED, ports))
+        phases.append(await _phase(
+            'udp_detect',
+            detections(detector().stream_udp_protocols(targets)),
+            {port: UDP_SERVICES[kind] for port, kind in udp.items()},
+            DetectionResult.CLOSED, ports))
+    return phases
+
+
+def _main(args: argparse.Namespace):
+    ports = sorted({port for r in parse_ports(args.ports) for port in r})
+    farm = ServiceFarm(
+        args.address,
+        make_plan(ports, TCP_SERVICES, args.open, args.seed),
+        make_plan(ports, UDP_SERVICES, args.open, args.seed + 1),
+        args.delay / 1000)
+    farm.start()
+    try:
+        phases = asyncio.run(_bench(args, farm, ports))
+    finally:
+        farm.stop()
+
+    report = {
+        'address': args.address,
+        'ports': len(ports),
+        'tcp_services': len(farm.tcp),
+        'udp_services': len(farm.udp),
+        'unavailable_ports': len(farm.failed),
+        'timing': args.timing,
+        'timeout': args.timeout,
+        'concurrency': args.concurrency,
+        'delay_ms': args.delay,
+        'phases': phases,
+    }
+    if args.json:
+        print(json.dumps(report))
+        return
+    for key, value in report.items():
+        if key != 'phases':
+            print(f"{key}: {value}")
+    for phase in phases:
+        print()
+        for key, value in phase.items():
+            if key == 'errors':
+                for error in value:
+                    print(f"  {error}")
+            else:
+                print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark for the port scanner and "
+                    "protocol detector"
+    )
+    parser.add_argument(
+        "--protocol",
+        type=str,
+        choices=["tcp", "udp", "both"],
+        default="both",
+        help="Which scan paths to measure"
+    )
+    parser.add_argument(
+        "--address", "-a",
+        type=str,
+        help="Loopback address for the stand-in services; any of "
+             "127.0.0.0/8 works on Linux",
+        default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--ports", "-p",
+        type=str,
+        help="Ports to scan, e.g. 20000-21999",
+        default="20000-21999"
+    )
+    parser.add_argument(
+        "--open",
+        type=float,
+        help="Fraction of the ports with a stand-in service, "
+             "per protocol",
+        default=0.05
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        help="Extra reply delay of the slow services, ms",
+        default=100
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed of the service layout",
+        default=1
+    )
+    parser.add_argument(
+        "--timing", "-T",
+        type=str,
+        choices=list(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="Timing profile of the scanner"
+    )
+    parser.add_argument(
+        "--timeout", "-t",
+        type=float,
+        help="Scanner timeout (default: from the timing profile)"
+    )
+    parser.add_argument(
+        "--concurrency", "-c",
+        type=int,
+        help="Scanner concurrency bound "
+             "(default: from the timing profile)"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the report as one JSON object"
+    )
+    _main(parser.parse_args())
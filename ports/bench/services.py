@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+import random
+import signal
+
+from ports.detector import DetectionResult
+
+# Stand-in services and what the detector should make of them. "-slow"
+# variants answer after the farm's delay.
+TCP_SERVICES = {
+    'http': DetectionResult.HTTP,
+    'smtp': DetectionResult.SMTP,
+    'pop3': DetectionResult.POP3,
+    'silent': DetectionResult.UNKNOWN,
+    'http-slow': DetectionResult.HTTP,
+    'smtp-slow': DetectionResult.SMTP,
+}
+UDP_SERVICES = {
+    'dns': DetectionResult.DNS,
+    'sntp': DetectionResult.SNTP,
+    'silent': DetectionResult.OPEN_FILTERED,
+    'dns-slow': DetectionResult.DNS,
+}
+
+_HTTP_RESPONSE = (b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n"
+                  b"Content-Length: 5\r\n\r\nbench")
+_SMTP_BANNER = b"220 bench.test ESMTP ready\r\n"
+_POP3_BANNER = b"+OK bench POP3 ready\r\n"
+# Version 4, mode 4 (server), stratum 1
+_SNTP_REPLY = b'\x24\x01' + 46 * b'\0'
+
+
+def make_plan(ports: range, services: dict[str, DetectionResult],
+              fraction: float, seed: int) -> dict[int, str]:
+    # A random fraction of the ports gets a service, the kinds taking
+    # turns; the rest of the range stays closed
+    rng = random.Random(seed)
+    count = round(len(ports) * fraction)
+    chosen = sorted(rng.sample(ports, count))
+    kinds = list(services)
+    return {port: kinds[i % len(kinds)] for i, port in enumerate(chosen)}
+
+
+async def _tcp_service(kind: str, delay: float,
+                       reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+    try:
+        if kind.endswith('-slow'):
+            await asyncio.sleep(delay)
+            kind = kind[:-len('-slow')]
+        if kind == 'http':
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(_HTTP_RESPONSE)
+        elif kind == 'smtp':
+            writer.write(_SMTP_BANNER)
+        elif kind == 'pop3':
+            writer.write(_POP3_BANNER)
+        await writer.drain()
+        # Hold the connection until the client is done with it
+        await reader.read()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class _UdpService(asyncio.DatagramProtocol):
+    def __init__(self, kind: str, delay: float):
+        self._kind = kind.removesuffix('-slow')
+        self._delay = delay if kind.endswith('-slow') else 0.0
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        if self._kind == 'dns':
+            # Echo the question back as an empty response
+            if len(data) < 12 or data[2] & 0x80:
+                return
+            reply = data[:2] + b'\x81\x80' + data[4:]
+        elif self._kind == 'sntp':
+            if len(data) != 48:
+                return
+            reply = _SNTP_REPLY
+        else:
+            return
+        if self._delay:
+            asyncio.get_running_loop().call_later(
+                self._delay, self._transport.sendto, reply, addr)
+        else:
+            self._transport.sendto(reply, addr)
+
+
+async def _serve(address: str, tcp: dict[int, str], udp: dict[int, str],
+                 delay: float, ready):
+    loop = asyncio.get_running_loop()
+    failed = []
+    for port, kind in tcp.items():
+        try:
+            await asyncio.start_server(
+                lambda r, w, kind=kind: _tcp_service(kind, delay, r, w),
+                address, port, backlog=1024)
+        except OSError:
+            failed.append(('tcp', port))
+    for port, kind in udp.items():
+        try:
+            await loop.create_datagram_endpoint(
+                lambda kind=kind: _UdpService(kind, delay),
+                local_addr=(address, port))
+        except OSError:
+            failed.append(('udp', port))
+    ready.send(failed)
+    await loop.create_future()
+
+
+def _run(address, tcp, udp, delay, ready):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(address, tcp, udp, delay, ready))
+
+
+class ServiceFarm:
+    # Listeners for a plan, in a child process so that they neither
+    # compete with the scanner for its event loop nor count towards
+    # its descriptors and memory
+    def __init__(self, address: str, tcp: dict[int, str],
+                 udp: dict[int, str], delay: float):
+        self.address = address
+        self.tcp = tcp
+        self.udp = udp
+        self._delay = delay
+        self._process = None
+        # Ports another program already holds; left out of the scoring
+        self.failed: set[tuple[str, int]] = set()
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_run, daemon=True,
+            args=(self.address, self.tcp, self.udp, self._delay, sender))
+        self._process.start()
+        sender.close()
+        self.failed = set(receiver.recv())
+        receiver.close()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
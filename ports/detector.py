@@ -1,158 +1,196 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from enum import Enum, auto
+import asyncio
+from enum import Enum
 from ipaddress import IPv4Address
-import random
 
 import socket
-import struct
-from typing import Callable
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+from ports import engine, signatures
+from ports.timing import (DEFAULT_PROFILE, ScanTiming, TimingProfile,
+                          concurrency_argument, tcp_connect,
+                          udp_exchange)
 
-_HTTP_TEST = b"GET / HTTP/1.0\r\n\r\n"
-_SMTP_TEST = b"EHLO test\r\n"
-_POP3_TEST = b"QUIT\r\n"
+# One member per protocol in the signature data. OPEN_FILTERED (UDP
+# only) means no reply to any probe and no ICMP error.
+DetectionResult = Enum('DetectionResult', [
+    'UNKNOWN', 'CLOSED',
+    *(protocol.upper() for protocol in signatures.PROTOCOLS),
+    'OPEN_FILTERED', 'FILTERED'])
 
 
-class DetectionResult(Enum):
-    UNKNOWN = auto()
-    CLOSED = auto()
-    HTTP = auto()
-    SMTP = auto()
-    POP3 = auto()
-    DNS = auto()
-    SNTP = auto()
+Detection = tuple[IPv4Address, int, DetectionResult]
 
 
 class ProtocolDetector:
     def __init__(self,
-                 timeout: float = 0.3,
-                 max_workers: int = 100):
-        self._timeout = timeout
-        self._workers = max_workers
+                 timeout: float | None = None,
+                 concurrency: int | None = None,
+                 profile: TimingProfile | str = DEFAULT_PROFILE,
+                 max_workers: int | None = None):
+        concurrency = concurrency_argument(concurrency, max_workers)
+        self.timing = ScanTiming(profile, timeout, concurrency)
+        # Banners and replies take server time on top of the RTT,
+        # so reads wait for the fixed timeout
+        self._timeout = (self.timing.profile.initial_timeout
+                         if timeout is None else timeout)
 
     def detect_tcp_protocols(self,
                              ip: IPv4Address,
                              start: int, end: int
                              ) -> dict[int, DetectionResult]:
-        return self._detect_protocols(self.detect_tcp_protocol, ip, start, end)
+        return self._detect_protocols(self._detect_tcp, ip, start, end)
 
     def detect_udp_protocols(self,
                              ip: IPv4Address,
                              start: int, end: int
                              ) -> dict[int, DetectionResult]:
-        return self._detect_protocols(self.detect_udp_protocol, ip, start, end)
+        return self._detect_protocols(self._detect_udp, ip, start, end)
+
+    def stream_tcp_protocols(self,
+                             targets: Iterable[tuple[IPv4Address, int]],
+                             closed: bool = False
+                             ) -> AsyncIterator[Detection]:
+        return self._stream_protocols(self._detect_tcp, targets, closed)
+
+    def stream_udp_protocols(self,
+                             targets: Iterable[tuple[IPv4Address, int]],
+                             closed: bool = False
+                             ) -> AsyncIterator[Detection]:
+        return self._stream_protocols(self._detect_udp, targets, closed)
 
     def detect_tcp_protocol(self,
                             ip: IPv4Address,
                             port: int) -> DetectionResult:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(self._timeout)
-                sock.connect((str(ip), port))
-
-                if self._is_http(sock):
-                    return DetectionResult.HTTP
-                elif self._is_smtp(sock):
-                    return DetectionResult.SMTP
-                elif self._is_pop3(sock):
-                    return DetectionResult.POP3
-                else:
-                    return DetectionResult.UNKNOWN
-        except socket.error:
-            return DetectionResult.CLOSED
+        return asyncio.run(self._detect_tcp(ip, port))
 
     def detect_udp_protocol(self,
                             ip: IPv4Address,
                             port: int) -> DetectionResult:
+        return asyncio.run(self._detect_udp(ip, port))
+
+    async def _detect_tcp(self,
+                          ip: IPv4Address,
+                          port: int) -> DetectionResult:
+        # Most services either greet first or answer the first probe,
+        # so one connection and one read settle the common case
+        sock = await tcp_connect(ip, port, self.timing)
+        if sock is None:
+            return DetectionResult.CLOSED
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                sock.settimeout(self._timeout)
-                sock.connect((str(ip), port))
-
-                if self._is_sntp(sock):
-                    return DetectionResult.SNTP
-                elif self._is_dns(sock):
-                    return DetectionResult.DNS
-                else:
+            banner = await self._read(sock, self._timeout)
+            if banner:
+                return _result(signatures.PASSIVE.match(banner))
+            if banner is not None:
+                sock.close()
+                sock = None
+            for probe in signatures.TCP:
+                if sock is None:
+                    sock = await tcp_connect(ip, port, self.timing)
+                    if sock is None:
+                        break
+                reply = await self._exchange(sock, probe)
+                if reply:
+                    protocol = (probe.signatures.match(reply)
+                                or signatures.PASSIVE.match(reply))
+                    if protocol:
+                        return _result(protocol)
+                if reply is not None:
+                    # An error reply or a hang-up; the next probe gets
+                    # a fresh connection, without the leftovers
+                    sock.close()
+                    sock = None
+            return DetectionResult.UNKNOWN
+        finally:
+            if sock is not None:
+                sock.close()
+
+    async def _detect_udp(self,
+                          ip: IPv4Address,
+                          port: int) -> DetectionResult:
+        with engine.udp_socket() as sock:
+            try:
+                await self._loop.sock_connect(sock, (str(ip), port))
+                replied = False
+                for probe in signatures.UDP:
+                    # Paced and retried like a UDP scan; the reply
+                    # waits at least the fixed timeout like a banner,
+                    # longer for a host slower than that
+                    timeout = (self._timeout if probe.timeout is None
+                               else probe.timeout)
+                    reply = await udp_exchange(
+                        sock, ip, probe.payload, self.timing,
+                        max(timeout, self.timing.timeout(ip)))
+                    if reply:
+                        protocol = probe.signatures.match(reply)
+                        if protocol:
+                            return _result(protocol)
+                        replied = True
+                if replied:
                     return DetectionResult.UNKNOWN
-        except socket.error:
-            return DetectionResult.CLOSED
+                return DetectionResult.OPEN_FILTERED
+            except ConnectionRefusedError:
+                return DetectionResult.CLOSED
+            except OSError as e:
+                self.timing.on_error(e)
+                if e.errno in engine.FILTERED_ERRNOS:
+                    return DetectionResult.FILTERED
+                return DetectionResult.CLOSED
 
     def _detect_protocols(self,
-                          func: Callable[[IPv4Address, int], DetectionResult],
+                          func: Callable[[IPv4Address, int],
+                                         Awaitable[DetectionResult]],
                           ip: IPv4Address,
                           start: int, end: int) -> dict[int, DetectionResult]:
-        protocols: dict[int, DetectionResult] = {}
-        with (ThreadPoolExecutor(max_workers=self._workers) as executor):
-            future_to_port = {}
-
-            for port in range(start, end):
-                future = executor.submit(func, ip, port)
-                future_to_port[future] = port
-
-            for future in as_completed(future_to_port):
-                port = future_to_port[future]
-                result = future.result()
-                if result != DetectionResult.CLOSED:
-                    protocols[port] = result
-        return protocols
-
-    def _is_http(self, sock: socket.socket) -> bool:
-        try:
-            sock.sendall(_HTTP_TEST)
-            resp = sock.recv(1024)
-            return resp and b"HTTP/1." in resp
-        except socket.error:
-            return False
-
-    def _is_smtp(self, sock: socket.socket) -> bool:
-        try:
-            banner = sock.recv(1024)
-            if b"SMTP" in banner or b"220" in banner:
-                return True
-
-            sock.sendall(_SMTP_TEST)
-            response = sock.recv(1024)
-            return b"250" in response or b"SMTP" in response
-        except socket.error:
-            return False
-
-    def _is_pop3(self, sock: socket.socket) -> bool:
-        try:
-            sock.settimeout(self._timeout)
-
-            banner = sock.recv(1024)
-            if b"+OK" in banner or b"POP3" in banner:
-                return True
-    
-            sock.sendall(_POP3_TEST)
-            response = sock.recv(1024)
-            return b"+OK" in response or b"POP3" in response
-        except socket.error:
-            return False
-
-    def _is_sntp(self, sock: socket.socket) -> bool:
+        results = engine.run(
+            lambda port: func(ip, port), range(start, end),
+            self.timing.limit,
+            keep=lambda result: result != DetectionResult.CLOSED)
+        return dict(results)
+
+    async def _stream_protocols(self,
+                                func: Callable[[IPv4Address, int],
+                                               Awaitable[DetectionResult]],
+                                targets: Iterable[tuple[IPv4Address, int]],
+                                closed: bool
+                                ) -> AsyncIterator[Detection]:
+        # closed also yields the closed ports, for callers that track
+        # every target
+        async for (ip, port), result in engine.bounded(
+                lambda target: func(*target), targets,
+                self.timing.limit):
+            if closed or result != DetectionResult.CLOSED:
+                yield ip, port, result
+
+    @property
+    def _loop(self) -> asyncio.AbstractEventLoop:
+        return asyncio.get_running_loop()
+
+    async def _read(self, sock: socket.socket,
+                    timeout: float) -> bytes | None:
+        # None when nothing came in time, b'' when the peer hung up
+        # or the connection failed
         try:
-            packet = b'\x1b' + 47 * b'\0'
-            sock.send(packet)
-            data = sock.recv(512)
-            return data and len(data) == 48
-        except socket.error:
-            return False
-    
-    def _is_dns(self, sock: socket.socket) -> bool:
+            return await asyncio.wait_for(self._loop.sock_recv(sock, 4096),
+                                          timeout)
+        except asyncio.TimeoutError:
+            return None
+        except OSError:
+            return b''
+
+    async def _exchange(self, sock: socket.socket,
+                        probe: signatures.Probe) -> bytes | None:
+        timeout = self._timeout if probe.timeout is None else probe.timeout
         try:
-            transaction_id = random.randint(0, 0xFFFF)
-            header = struct.pack(">HHHHHH", transaction_id,
-                                 0x0100, 1, 0, 0, 0)
-            qname = b''.join([bytes([len(part)]) + part.encode()
-                              for part in "google.com".split('.')]) + b'\x00'
-            question = struct.pack(">HH", 1, 1)
-            packet = header + qname + question
-    
-            sock.send(packet)
-            data = sock.recv(512)
-            expected = struct.pack(">H", transaction_id)
-            return data and len(data) >= 12 and data[:2] == expected
-        except socket.error:
-            return False
+            await asyncio.wait_for(
+                self._loop.sock_sendall(sock, probe.payload), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except OSError:
+            return b''
+        return await self._read(sock, timeout)
+
+
+def _result(protocol: str | None) -> DetectionResult:
+    if protocol is None:
+        return DetectionResult.UNKNOWN
+    return DetectionResult[protocol.upper()]
@@ -0,0 +1,95 @@
+import asyncio
+import errno
+import resource
+import socket
+import sys
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_CONCURRENCY = 1000
+# Not exported by the socket module before Python 3.12
+_IP_RECVERR = getattr(socket, 'IP_RECVERR',
+                      11 if sys.platform == 'linux' else None)
+# ICMP unreachable codes other than "port unreachable", as reported
+# on a socket with IP_RECVERR; a filter, not a closed port
+FILTERED_ERRNOS = {errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EACCES,
+                   errno.EPERM}
+# File descriptors kept free for the interpreter, logging and the like
+_RESERVED_FDS = 64
+
+
+def udp_socket() -> socket.socket:
+    # A non-blocking UDP socket that will be connected to one target.
+    # Connecting is what makes the kernel hand ICMP port-unreachable
+    # back as ECONNREFUSED, without root or raw sockets; IP_RECVERR
+    # adds the other unreachable codes.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    if _IP_RECVERR is not None:
+        sock.setsockopt(socket.IPPROTO_IP, _IP_RECVERR, 1)
+    return sock
+
+
+def concurrency_limit(requested: int) -> int:
+    # Each probe holds a socket, so in-flight probes cannot exceed
+    # what the descriptor limit leaves room for.
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return max(requested, 1)
+    return max(min(requested, soft - _RESERVED_FDS), 1)
+
+
+async def bounded(probe: Callable[[T], Awaitable[R]], items: Iterable[T],
+                  concurrency: int | Callable[[], int]
+                  ) -> AsyncIterator[tuple[T, R]]:
+    # Runs probe over items with at most concurrency of them in flight,
+    # yielding results as they complete. concurrency may be a callable
+    # read before every refill, so a rate controller can move the limit
+    # during the scan. Items are drawn lazily, so memory stays flat
+    # however long the input is.
+    items = iter(items)
+    running: dict[asyncio.Task, T] = {}
+    if callable(concurrency):
+        fd_limit = concurrency_limit(2 ** 31)
+        limit = lambda: min(concurrency(), fd_limit)
+    else:
+        limit = lambda: concurrency
+
+    def refill():
+        capacity = limit()
+        if len(running) >= capacity:
+            return
+        for item in items:
+            running[asyncio.ensure_future(probe(item))] = item
+            if len(running) >= capacity:
+                return
+
+    refill()
+    try:
+        while running:
+            done, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield running.pop(task), task.result()
+            refill()
+    finally:
+        for task in running:
+            task.cancel()
+
+
+def run(probe: Callable[[T], Awaitable[R]], items: Iterable[T],
+        concurrency: int | Callable[[], int] = DEFAULT_CONCURRENCY,
+        keep: Callable[[R], bool] = bool) -> list[tuple[T, R]]:
+    # Synchronous entry point that only holds on to the results worth
+    # keeping, e.g. open ports out of a full range.
+    if not callable(concurrency):
+        concurrency = concurrency_limit(concurrency)
+
+    async def collect():
+        return [(item, result) async for item, result in
+                bounded(probe, items, concurrency)
+                if keep(result)]
+
+    return asyncio.run(collect())
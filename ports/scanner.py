@@ -1,16 +1,31 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
+import asyncio
+from enum import Enum
 from ipaddress import IPv4Address
-import socket
-from typing import Callable
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+from ports import engine
+from ports.timing import (DEFAULT_PROFILE, ScanTiming, TimingProfile,
+                          concurrency_argument, tcp_connect,
+                          udp_exchange)
+
+
+class PortState(Enum):
+    OPEN = "open"
+    # No reply and no ICMP error: an open port of a silent service,
+    # or a dropped probe
+    OPEN_FILTERED = "open|filtered"
+    FILTERED = "filtered"
+    CLOSED = "closed"
 
 
 class PortScanner:
     def __init__(self,
-                 timeout: float = 0.3,
-                 max_workers: int = 100):
-        self._timeout = timeout
-        self._workers = max_workers
+                 timeout: float | None = None,
+                 concurrency: int | None = None,
+                 profile: TimingProfile | str = DEFAULT_PROFILE,
+                 max_workers: int | None = None):
+        concurrency = concurrency_argument(concurrency, max_workers)
+        self.timing = ScanTiming(profile, timeout, concurrency)
 
     def open_tcp_ports(self,
                        ip: IPv4Address,
@@ -22,40 +37,79 @@ class PortScanner:
                        start: int, end: int) -> list[int]:
         return self._open_ports(self._is_udp_port_open, ip, start, end)
 
+    def stream_tcp_ports(self,
+                         targets: Iterable[tuple[IPv4Address, int]]
+                         ) -> AsyncIterator[tuple[IPv4Address, int]]:
+        return self._stream_ports(self._is_tcp_port_open, targets)
+
+    def stream_udp_ports(self,
+                         targets: Iterable[tuple[IPv4Address, int]]
+                         ) -> AsyncIterator[tuple[IPv4Address, int]]:
+        return self._stream_ports(self._is_udp_port_open, targets)
+
+    async def _stream_ports(self,
+                            func: Callable[[IPv4Address, int],
+                                           Awaitable[bool]],
+                            targets: Iterable[tuple[IPv4Address, int]]
+                            ) -> AsyncIterator[tuple[IPv4Address, int]]:
+        async for target, is_open in engine.bounded(
+                lambda target: func(*target), targets,
+                self.timing.limit):
+            if is_open:
+                yield target
+
+    def udp_port_states(self,
+                        ip: IPv4Address,
+                        start: int, end: int) -> dict[int, PortState]:
+        results = engine.run(
+            lambda port: self._udp_port_state(ip, port),
+            range(start, end), self.timing.limit,
+            keep=lambda state: state != PortState.CLOSED)
+        return dict(sorted(results))
+
+    async def stream_udp_port_states(
+            self, targets: Iterable[tuple[IPv4Address, int]]
+    ) -> AsyncIterator[tuple[IPv4Address, int, PortState]]:
+        async for (ip, port), state in engine.bounded(
+                lambda target: self._udp_port_state(*target), targets,
+                self.timing.limit):
+            if state != PortState.CLOSED:
+                yield ip, port, state
+
     def _open_ports(self,
-                    func: Callable[[IPv4Address, int], bool],
+                    func: Callable[[IPv4Address, int], Awaitable[bool]],
                     ip: IPv4Address,
                     start: int, end: int) -> list[int]:
-        open_ports = []
-        with ThreadPoolExecutor(max_workers=self._workers) as executor:
-            futures = {
-                executor.submit(
-                    func, ip, port): port
-                for port in range(start, end)
-            }
-            for future in as_completed(futures):
-                port = futures[future]
-                if future.result():
-                    open_ports.append(port)
-        return sorted(open_ports)
-
-    def _is_tcp_port_open(self, ip: IPv4Address, port: int) -> bool:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(self._timeout)
-                return sock.connect_ex((str(ip), port)) == 0
-        except socket.error:
-            return False
+        results = engine.run(lambda port: func(ip, port),
+                             range(start, end), self.timing.limit)
+        return sorted(port for port, _ in results)
 
-    def _is_udp_port_open(self, ip: IPv4Address, port: int) -> bool:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                sock.settimeout(self._timeout)
-                sock.sendto(b'\x00', (str(ip), port))
-                try:
-                    sock.recvfrom(1024)
-                    return True
-                except socket.timeout:
-                    return True
-        except socket.error:
+    async def _is_tcp_port_open(self, ip: IPv4Address, port: int) -> bool:
+        sock = await tcp_connect(ip, port, self.timing)
+        if sock is None:
             return False
+        sock.close()
+        return True
+
+    async def _is_udp_port_open(self, ip: IPv4Address, port: int) -> bool:
+        return await self._udp_port_state(ip, port) in (
+            PortState.OPEN, PortState.OPEN_FILTERED)
+
+    async def _udp_port_state(self, ip: IPv4Address, port: int
+                              ) -> PortState:
+        loop = asyncio.get_running_loop()
+        with engine.udp_socket() as sock:
+            try:
+                await loop.sock_connect(sock, (str(ip), port))
+            except OSError as e:
+                self.timing.on_error(e)
+                return PortState.FILTERED
+            try:
+                reply = await udp_exchange(sock, ip, b'\x00', self.timing)
+            except ConnectionRefusedError:
+                return PortState.CLOSED
+            except OSError:
+                return PortState.FILTERED
+        if reply is None:
+            return PortState.OPEN_FILTERED
+        return PortState.OPEN
@@ -0,0 +1,85 @@
+import re
+import struct
+from dataclasses import dataclass
+
+# Detection data. A signature is (protocol, pattern); patterns are
+# matched at the start of what the server sent and must not use named
+# groups. Adding a protocol is adding a line here, it also becomes a
+# DetectionResult member.
+
+# What servers say on their own right after the connect, in priority
+# order: the first matching pattern wins.
+PASSIVE_SIGNATURES = (
+    ('ssh', rb'SSH-\d\.\d+-'),
+    ('ftp', rb'220[ -][^\r\n]*(?i:ftp)'),
+    ('smtp', rb'220[ -]'),
+    ('pop3', rb'\+OK'),
+    ('imap', rb'\* (?:OK|PREAUTH)'),
+    ('vnc', rb'RFB \d{3}\.\d{3}\n'),
+    # Handshake packet: length, sequence 0, protocol 10, version
+    ('mysql', rb'(?s:...)\x00\x0a\d'),
+)
+
+# Tried in order only when a TCP server stays silent: name, payload
+# and the signatures of the replies it provokes.
+TCP_PROBES = (
+    ('http', b"GET / HTTP/1.0\r\n\r\n", (('http', rb'HTTP/\d\.\d \d{3}'),)),
+    ('redis', b"PING\r\n", (('redis', rb'\+PONG'),)),
+)
+
+# A DNS query for google.com A with a fixed ID, so the reply can be
+# recognised by a pattern
+_DNS_ID = 0x5053
+_DNS_QUERY = (struct.pack(">HHHHHH", _DNS_ID, 0x0100, 1, 0, 0, 0)
+              + b'\x06google\x03com\x00' + struct.pack(">HH", 1, 1))
+
+# First byte of an SNTP reply: version 1 to 4, mode 4 (server)
+_SNTP_SERVER = bytes(byte for byte in range(256)
+                     if byte & 7 == 4 and 1 <= byte >> 3 & 7 <= 4)
+
+UDP_PROBES = (
+    ('sntp', b'\x1b' + 47 * b'\0',
+     (('sntp', b'[' + re.escape(_SNTP_SERVER) + rb'](?s:.{47})\Z'),)),
+    ('dns', _DNS_QUERY,
+     (('dns', re.escape(struct.pack(">H", _DNS_ID)) + rb'[\x80-\xff]'),)),
+)
+
+
+class SignatureSet:
+    # All patterns compiled into one alternation, so a banner is matched
+    # against the whole set in a single pass
+    def __init__(self, signatures):
+        self._protocols = [protocol for protocol, _ in signatures]
+        self._regex = re.compile(b'|'.join(
+            b'(?P<s%d>%s)' % (index, pattern)
+            for index, (_, pattern) in enumerate(signatures)))
+
+    def match(self, data: bytes) -> str | None:
+        match = self._regex.match(data)
+        if match is None:
+            return None
+        return self._protocols[int(match.lastgroup[1:])]
+
+
+@dataclass(frozen=True)
+class Probe:
+    name: str
+    payload: bytes
+    signatures: SignatureSet
+    timeout: float | None = None
+
+
+def _probes(entries) -> tuple[Probe, ...]:
+    return tuple(Probe(name, payload, SignatureSet(signatures))
+                 for name, payload, signatures in entries)
+
+
+PASSIVE = SignatureSet(PASSIVE_SIGNATURES)
+TCP = _probes(TCP_PROBES)
+UDP = _probes(UDP_PROBES)
+
+# Every protocol name, in the order it first appears above
+PROTOCOLS = tuple(dict.fromkeys(
+    [protocol for protocol, _ in PASSIVE_SIGNATURES]
+    + [protocol for _, _, signatures in TCP_PROBES + UDP_PROBES
+       for protocol, _ in signatures]))
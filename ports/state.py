@@ -0,0 +1,234 @@
+import heapq
+import sqlite3
+import time
+from ipaddress import IPv4Address, IPv4Network
+from itertools import islice
+from typing import Iterator
+
+from ports.detector import Detection, DetectionResult
+from ports.targets import pairs
+
+# Results are only stored for ports that were found open at some point,
+# a port that closes later keeps its row with CLOSED. Ports that were
+# never open are covered by the scans table instead: a finished scan
+# says every port in its range was closed unless a result says
+# otherwise.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ip INTEGER NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    result TEXT NOT NULL,
+    scanned REAL NOT NULL,
+    PRIMARY KEY (ip, port, protocol)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    protocol TEXT NOT NULL,
+    targets TEXT NOT NULL,
+    ports TEXT NOT NULL,
+    started REAL NOT NULL,
+    -- Every (host, port) pair before this position in the scan order
+    -- has been probed
+    done INTEGER NOT NULL DEFAULT 0,
+    finished REAL,
+    -- Oldest time the closed ports of the whole range were seen
+    -- closed; older than started when an incremental scan relied on
+    -- earlier scans
+    fresh REAL
+);
+"""
+# How often results and the checkpoint are written out
+_COMMIT_INTERVAL = 1.0
+
+Target = tuple[IPv4Address, int]
+
+
+def _ports_key(ports: list[range]) -> str:
+    return ','.join(f'{r.start}-{r.stop - 1}' for r in ports)
+
+
+def _parse_ports_key(key: str) -> list[range]:
+    ports = []
+    for item in key.split(','):
+        first, _, last = item.partition('-')
+        ports.append(range(int(first), int(last) + 1))
+    return ports
+
+
+class _Coverage:
+    def __init__(self, networks: list[IPv4Network], ports: list[range]):
+        self.networks = networks
+        self.ports = ports
+
+    def __contains__(self, target: Target) -> bool:
+        ip, port = target
+        return (any(port in r for r in self.ports)
+                and any(ip in network for network in self.networks))
+
+
+class ScanState:
+    # Scan results and checkpoints in a SQLite file, so interrupted
+    # scans resume and repeated scans skip what is known
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def session(self, protocol: str,
+                networks: list[IPv4Network], ports: list[range],
+                incremental: bool = False,
+                max_age: float = 7 * 24 * 3600) -> 'ScanSession':
+        return ScanSession(self._db, protocol, networks, ports,
+                           incremental, max_age)
+
+    def close(self):
+        self._db.close()
+
+
+class ScanSession:
+    # One run of a scan. An unfinished scan of the same protocol,
+    # targets and ports is picked up where its checkpoint left off.
+    # In incremental mode ports known to be open go first, and ports
+    # that a recent enough scan saw closed are skipped.
+    def __init__(self, db: sqlite3.Connection, protocol: str,
+                 networks: list[IPv4Network], ports: list[range],
+                 incremental: bool, max_age: float):
+        self._db = db
+        self._protocol = protocol
+        self._networks = networks
+        self._ports = ports
+        self._coverage = _Coverage(networks, ports)
+        now = time.time()
+        targets_key = ','.join(str(network) for network in networks)
+        ports_key = _ports_key(ports)
+
+        row = db.execute(
+            "SELECT id, started, done, fresh FROM scans WHERE protocol = ?"
+            " AND targets = ? AND ports = ? AND finished IS NULL"
+            " ORDER BY id DESC LIMIT 1",
+            (protocol, targets_key, ports_key)).fetchone()
+        if row is not None:
+            self.id, self.started, self._done, self._fresh = row
+            self.resumed = True
+        else:
+            self.id = db.execute(
+                "INSERT INTO scans (protocol, targets, ports, started, fresh)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (protocol, targets_key, ports_key, now, now)).lastrowid
+            self.started, self._done, self._fresh = now, 0, now
+            self.resumed = False
+            db.commit()
+
+        self._known: list[Target] = []
+        self._recent: list[tuple[float, _Coverage]] = []
+        if incremental:
+            self._known = [
+                target for target in (
+                    (IPv4Address(ip), port) for ip, port in db.execute(
+                        "SELECT ip, port FROM results WHERE protocol = ?"
+                        " AND result != 'CLOSED' ORDER BY ip, port",
+                        (protocol,)))
+                if target in self._coverage]
+            self._recent = [
+                (fresh, _Coverage(
+                    [IPv4Network(network) for network in targets.split(',')],
+                    _parse_ports_key(ports)))
+                for fresh, targets, ports in db.execute(
+                    "SELECT fresh, targets, ports FROM scans"
+                    " WHERE protocol = ? AND finished IS NOT NULL"
+                    " AND fresh >= ? ORDER BY fresh DESC",
+                    (protocol, now - max_age))]
+
+        self.skipped = 0
+        self._pending: dict[Target, list[int]] = {}
+        self._in_flight: set[int] = set()
+        self._heap: list[int] = []
+        self._next = self._done
+        self._writes: list[tuple] = []
+        self._last_commit = time.monotonic()
+
+    def previous(self) -> list[Detection]:
+        # What a resumed scan had already found, less what is about to
+        # be probed again
+        if not self.resumed:
+            return []
+        known = set(self._known)
+        found = []
+        for ip, port, result in self._db.execute(
+                "SELECT ip, port, result FROM results WHERE protocol = ?"
+                " AND scanned >= ? AND result != 'CLOSED'",
+                (self._protocol, self.started)):
+            target = (IPv4Address(ip), port)
+            if target in self._coverage and target not in known:
+                found.append((*target, _result(result)))
+        return found
+
+    def targets(self) -> Iterator[Target]:
+        yield from self._known
+        known = set(self._known)
+        for target in islice(pairs(self._networks, self._ports),
+                             self._done, None):
+            index = self._next
+            self._next += 1
+            if target in known or self._is_fresh(target):
+                self.skipped += 1
+                continue
+            self._pending.setdefault(target, []).append(index)
+            self._in_flight.add(index)
+            heapq.heappush(self._heap, index)
+            yield target
+
+    def record(self, detection: Detection):
+        ip, port, result = detection
+        now = time.time()
+        if result == DetectionResult.CLOSED:
+            self._writes.append(
+                ("UPDATE results SET result = ?, scanned = ?"
+                 " WHERE ip = ? AND port = ? AND protocol = ?",
+                 (result.name, now, int(ip), port, self._protocol)))
+        else:
+            self._writes.append(
+                ("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                 (int(ip), port, self._protocol, result.name, now)))
+        indices = self._pending.get((ip, port))
+        if indices:
+            self._in_flight.discard(indices.pop(0))
+            if not indices:
+                del self._pending[(ip, port)]
+        if time.monotonic() - self._last_commit >= _COMMIT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        heap = self._heap
+        while heap and heap[0] not in self._in_flight:
+            heapq.heappop(heap)
+        done = heap[0] if heap else self._next
+        with self._db:
+            for statement, params in self._writes:
+                self._db.execute(statement, params)
+            self._db.execute("UPDATE scans SET done = ?, fresh = ?"
+                             " WHERE id = ?", (done, self._fresh, self.id))
+        self._writes.clear()
+        self._last_commit = time.monotonic()
+
+    def finish(self):
+        self.checkpoint()
+        with self._db:
+            self._db.execute("UPDATE scans SET finished = ? WHERE id = ?",
+                             (time.time(), self.id))
+
+    def _is_fresh(self, target: Target) -> bool:
+        for fresh, coverage in self._recent:
+            if target in coverage:
+                # This scan now only vouches for the range as of the
+                # scan it relied on
+                self._fresh = min(self._fresh, fresh)
+                return True
+        return False
+
+
+def _result(name: str) -> DetectionResult:
+    # Rows may name a protocol the signature table no longer has
+    return DetectionResult.__members__.get(name, DetectionResult.UNKNOWN)
@@ -0,0 +1,51 @@
+import socket
+from ipaddress import IPv4Address, IPv4Network
+from typing import Iterator
+
+
+def parse_targets(spec: str) -> list[IPv4Network]:
+    # Comma-separated addresses, CIDR ranges and host names;
+    # "@path" reads more of them from a file, one or more per line
+    networks = []
+    for item in _items(spec):
+        if item.startswith('@'):
+            with open(item[1:]) as f:
+                for line in f:
+                    networks += parse_targets(line.partition('#')[0])
+            continue
+        try:
+            networks.append(IPv4Network(item, strict=False))
+        except ValueError:
+            try:
+                networks.append(IPv4Network(socket.gethostbyname(item)))
+            except socket.gaierror:
+                raise ValueError(f"Unknown host: {item}") from None
+    return networks
+
+
+def parse_ports(spec: str) -> list[range]:
+    # "22,80,8000-8100", ranges include both ends
+    ports = []
+    for item in _items(spec):
+        first, _, last = item.partition('-')
+        start = int(first)
+        end = int(last) if last else start
+        if not 0 < start <= end <= 0xFFFF:
+            raise ValueError(f"Invalid port range: {item}")
+        ports.append(range(start, end + 1))
+    return ports
+
+
+def pairs(networks: list[IPv4Network],
+          ports: list[range]) -> Iterator[tuple[IPv4Address, int]]:
+    # Every host gets its first port before any host gets its second,
+    # so consecutive probes land on different targets
+    for port_range in ports:
+        for port in port_range:
+            for network in networks:
+                for host in network.hosts():
+                    yield host, port
+
+
+def _items(spec: str) -> list[str]:
+    return spec.replace(',', ' ').split()
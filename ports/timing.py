@@ -0,0 +1,254 @@
+import asyncio
+import errno
+import socket
+import warnings
+from dataclasses import dataclass
+from ipaddress import IPv4Address
+from time import monotonic
+
+from ports.engine import FILTERED_ERRNOS
+
+# Smoothed RTT gains and timeout formula as in TCP (RFC 6298)
+_ALPHA = 1 / 8
+_BETA = 1 / 4
+_K = 4
+# Per-target gap between UDP probes once ICMP rate limiting is seen.
+# Linux answers about one port-unreachable per second per host after
+# a short burst, so the gap doubles up to that.
+_MIN_SEND_DELAY = 0.05
+_MAX_SEND_DELAY = 1.0
+# Each first probe answered shrinks the gap by this factor, so a burst
+# of dropped errors does not slow a host down for the rest of the scan
+_SEND_DELAY_DECAY = 0.9
+# Local errors that mean we are sending faster than the host can
+_BACKOFF_ERRNOS = {errno.ENOBUFS, errno.EAGAIN, errno.EMFILE, errno.ENFILE}
+
+
+@dataclass(frozen=True)
+class TimingProfile:
+    name: str
+    initial_timeout: float
+    min_timeout: float
+    max_timeout: float
+    min_concurrency: int
+    initial_concurrency: int
+    max_concurrency: int
+    retries: int
+
+
+PROFILES = {profile.name: profile for profile in (
+    TimingProfile('polite', 1.0, 0.1, 10.0, 1, 10, 100, 2),
+    TimingProfile('normal', 1.0, 0.1, 10.0, 10, 100, 1000, 1),
+    TimingProfile('aggressive', 0.5, 0.05, 1.25, 50, 500, 5000, 1),
+    TimingProfile('insane', 0.25, 0.05, 0.3, 100, 1000, 10000, 0),
+)}
+DEFAULT_PROFILE = 'normal'
+
+
+class _Rtt:
+    __slots__ = ('srtt', 'rttvar', 'send_delay', 'next_send')
+
+    def __init__(self):
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.send_delay = 0.0
+        self.next_send = 0.0
+
+    def sample(self, rtt: float):
+        if not self.srtt:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += _BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += _ALPHA * (rtt - self.srtt)
+
+    @property
+    def timeout(self) -> float:
+        return self.srtt + _K * self.rttvar
+
+
+def concurrency_argument(concurrency: int | None,
+                         max_workers: int | None) -> int | None:
+    # max_workers is the old name of the concurrency bound, still
+    # accepted by the scanner and detector constructors
+    if max_workers is None:
+        return concurrency
+    if concurrency is not None:
+        raise TypeError("Pass concurrency or max_workers, not both")
+    warnings.warn("max_workers is deprecated, use concurrency",
+                  DeprecationWarning, stacklevel=3)
+    return max_workers
+
+
+# Per-target RTT estimates and an AIMD window for one scanner. Any
+# reply, a RST or an ICMP error included, is an RTT sample and grows
+# the window by one probe per window of replies. A timeout from a
+# target that has answered before looks like loss or ICMP rate
+# limiting and halves the window, at most once per smoothed RTT.
+# Silence from targets that never answered says nothing, dead hosts
+# and filtered ranges are expected.
+class ScanTiming:
+    def __init__(self, profile: TimingProfile | str = DEFAULT_PROFILE,
+                 timeout: float | None = None,
+                 concurrency: int | None = None):
+        if isinstance(profile, str):
+            profile = PROFILES[profile]
+        self.profile = profile
+        self.retries = profile.retries
+        self._initial_timeout = (profile.initial_timeout
+                                 if timeout is None else timeout)
+        self._max_timeout = max(profile.max_timeout, self._initial_timeout)
+        self._max_window = (profile.max_concurrency
+                            if concurrency is None else concurrency)
+        self._min_window = min(profile.min_concurrency, self._max_window)
+        self._window = float(min(profile.initial_concurrency,
+                                 self._max_window))
+        self._targets: dict[object, _Rtt] = {}
+        self._overall = _Rtt()
+        self._last_decrease = 0.0
+
+        self.timeouts = 0
+        self.decreases = 0
+
+    def limit(self) -> int:
+        return int(self._window)
+
+    def timeout(self, target) -> float:
+        rtt = self._targets.get(target)
+        if rtt is None:
+            # Before a target answers, other targets are the best guess
+            rtt = self._overall
+        if not rtt.srtt:
+            return self._initial_timeout
+        return min(max(rtt.timeout, self.profile.min_timeout),
+                   self._max_timeout)
+
+    def on_response(self, target, rtt: float):
+        estimate = self._targets.get(target)
+        if estimate is None:
+            estimate = self._targets[target] = _Rtt()
+        estimate.sample(rtt)
+        self._overall.sample(rtt)
+        self._window = min(self._window + 1 / self._window,
+                           self._max_window)
+
+    async def pace(self, target):
+        # Waits for the target's next send slot, if it is being paced
+        estimate = self._targets.get(target)
+        if estimate is None or not estimate.send_delay:
+            return
+        now = monotonic()
+        slot = max(estimate.next_send, now)
+        estimate.next_send = slot + estimate.send_delay
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def on_timeout(self, target):
+        self.timeouts += 1
+        if target in self._targets:
+            self._decrease()
+
+    def on_retry_answered(self, target):
+        # The first probe went unanswered but a retry did not: the reply,
+        # an ICMP error most likely, was dropped by rate limiting. A
+        # silent open port is no such evidence, it never answers.
+        estimate = self._targets.get(target)
+        if estimate is not None:
+            estimate.send_delay = min(
+                max(estimate.send_delay * 2, _MIN_SEND_DELAY),
+                _MAX_SEND_DELAY)
+
+    def on_first_answered(self, target):
+        estimate = self._targets.get(target)
+        if estimate is not None and estimate.send_delay:
+            estimate.send_delay *= _SEND_DELAY_DECAY
+            if estimate.send_delay < _MIN_SEND_DELAY:
+                estimate.send_delay = 0.0
+
+    def on_error(self, error: OSError):
+        if error.errno in _BACKOFF_ERRNOS:
+            self._decrease()
+
+    def _decrease(self):
+        now = monotonic()
+        if now - self._last_decrease < max(self._overall.srtt,
+                                           self.profile.min_timeout):
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self._window = max(self._window / 2, self._min_window)
+
+
+async def tcp_connect(ip: IPv4Address, port: int,
+                      timing: ScanTiming) -> socket.socket | None:
+    # A connected non-blocking socket, or None for a closed or
+    # filtered port. Timeouts are retried, as a lost SYN looks just
+    # like a filter otherwise.
+    loop = asyncio.get_running_loop()
+    for _ in range(timing.retries + 1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        started = monotonic()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (str(ip), port)),
+                                   timing.timeout(ip))
+            timing.on_response(ip, monotonic() - started)
+            return sock
+        except ConnectionRefusedError:
+            sock.close()
+            timing.on_response(ip, monotonic() - started)
+            return None
+        except asyncio.TimeoutError:
+            sock.close()
+            timing.on_timeout(ip)
+        except OSError as e:
+            sock.close()
+            timing.on_error(e)
+            return None
+        except BaseException:
+            sock.close()
+            raise
+    return None
+
+
+async def udp_exchange(sock: socket.socket, ip: IPv4Address,
+                       payload: bytes, timing: ScanTiming,
+                       timeout: float | None = None) -> bytes | None:
+    # Sends payload on a UDP socket connected to ip and returns the
+    # reply, or None when every attempt timed out. Sends to a target
+    # that rate limits ICMP are paced, lost probes are retried, and
+    # replies and ICMP errors are RTT samples. An ICMP error is raised:
+    # ConnectionRefusedError for a closed port, an OSError with one of
+    # FILTERED_ERRNOS for a filter.
+    loop = asyncio.get_running_loop()
+    for attempt in range(timing.retries + 1):
+        await timing.pace(ip)
+        started = monotonic()
+        try:
+            await loop.sock_sendall(sock, payload)
+            reply = await asyncio.wait_for(
+                loop.sock_recv(sock, 4096),
+                timing.timeout(ip) if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            # Lost probe, lost reply, filter or silent service
+            timing.on_timeout(ip)
+            continue
+        except OSError as e:
+            if (e.errno != errno.ECONNREFUSED
+                    and e.errno not in FILTERED_ERRNOS):
+                timing.on_error(e)
+                continue
+            _on_udp_answer(timing, ip, started, attempt)
+            raise
+        _on_udp_answer(timing, ip, started, attempt)
+        return reply
+    return None
+
+
+def _on_udp_answer(timing: ScanTiming, ip: IPv4Address, started: float,
+                   attempt: int):
+    timing.on_response(ip, monotonic() - started)
+    if attempt:
+        timing.on_retry_answered(ip)
+    else:
+        timing.on_first_answered(ip)
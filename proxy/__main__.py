@@ -5,17 +5,22 @@ import argparse
 
 from proxy.server import FilteringProxyServer
 
+_MIB = 1024 * 1024
+
 
 def _main(args: argparse.Namespace):
     domains: list[str] = []
     if args.filter is not None:
         try:
             with open(args.filter, 'r') as f:
-                domains = f.readlines()
+                domains = [line.strip() for line in f if line.strip()]
         except FileNotFoundError:
             parser.error("Filter file doesn't exist")
 
-    server = FilteringProxyServer(filter_domain=domains, port=args.port)
+    server = FilteringProxyServer(filter_domain=domains, port=args.port,
+                                  cache_dir=args.cache_dir,
+                                  cache_memory=args.cache_memory * _MIB,
+                                  cache_disk=args.cache_disk * _MIB)
     try:
         server.start()
     except Exception as e:
@@ -37,4 +42,22 @@ if __name__ == "__main__":
         type=pathlib.Path,
         help="Path to file with domains for filtering"
     )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        help="Directory for the disk tier of the response cache "
+             "(default: memory only)"
+    )
+    parser.add_argument(
+        '--cache-memory',
+        type=int,
+        default=64,
+        help="Memory budget of the response cache, MiB"
+    )
+    parser.add_argument(
+        '--cache-disk',
+        type=int,
+        default=1024,
+        help="Disk budget of the response cache, MiB"
+    )
     _main(parser.parse_args())
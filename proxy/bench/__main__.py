@@ -0,0 +1,149 @@
+import argparse
+import json
+import tracemalloc
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from proxy.bench.pages import make_page
+from proxy.parser import LinkRemoverPageParser
+
+_UNITS = {'k': 1024, 'm': 1024 * 1024}
+
+
+def _soup(page: bytes, chunk: int, keep: bool = True) -> bytes:
+    # The DOM-based filter the proxy used before: the whole page is
+    # parsed, every <a> decomposed and the tree serialized again
+    soup = BeautifulSoup(page, "html.parser")
+    for a_tag in soup.find_all("a"):
+        a_tag.decompose()
+    return soup.encode()
+
+
+def _streaming(page: bytes, chunk: int, keep: bool = True) -> bytes:
+    # Without keep the output is dropped as it comes, as the proxy
+    # sends it on, so the memory peak is the filter's own
+    parser = LinkRemoverPageParser()
+    out = []
+    for i in range(0, len(page), chunk):
+        data = parser.feed(page[i:i + chunk])
+        if keep:
+            out.append(data)
+    out.append(parser.close())
+    return b''.join(out)
+
+
+_FILTERS = {'beautifulsoup': _soup, 'streaming': _streaming}
+
+
+def _size(text: str) -> int:
+    unit = _UNITS.get(text[-1:].lower())
+    return int(float(text[:-1]) * unit) if unit else int(text)
+
+
+def _measure(func, page: bytes, chunk: int,
+             repeat: int) -> tuple[dict, bytes]:
+    best = float('inf')
+    for _ in range(repeat):
+        started = perf_counter()
+        output = func(page, chunk)
+        best = min(best, perf_counter() - started)
+    # A separate run, tracing allocations slows everything down
+    tracemalloc.start()
+    func(page, chunk, keep=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'time_ms': round(best * 1000, 2),
+        'mib_per_s': round(len(page) / best / 1024 / 1024, 1),
+        'peak_memory_kib': round(peak / 1024),
+        'output_bytes': len(output),
+    }, output
+
+
+def _content(html: bytes) -> tuple[str, list]:
+    # Text of the page and its elements with their attributes, as
+    # BeautifulSoup parses them
+    soup = BeautifulSoup(html, "html.parser")
+    tags = [(tag.name, sorted((key, str(val))
+                              for key, val in tag.attrs.items()))
+            for tag in soup.find_all(True)]
+    return ' '.join(soup.get_text().split()), tags
+
+
+def _bench(name: str, page: bytes, args: argparse.Namespace) -> dict:
+    report = {'page': name, 'bytes': len(page)}
+    outputs = {}
+    for filter_name, func in _FILTERS.items():
+        report[filter_name], outputs[filter_name] = _measure(
+            func, page, args.chunk, args.repeat)
+    # The filters agree when the pages read the same once parsed
+    streaming = _content(outputs['streaming'])
+    soup = _content(outputs['beautifulsoup'])
+    report['same_text'] = streaming[0] == soup[0]
+    report['same_tags'] = streaming[1] == soup[1]
+    report['speedup'] = round(report['beautifulsoup']['time_ms']
+                              / report['streaming']['time_ms'], 1)
+    return report
+
+
+def _main(args: argparse.Namespace):
+    pages = [(path, open(path, 'rb').read()) for path in args.page]
+    if not pages:
+        pages = [(f'synthetic-{size}', make_page(_size(size), args.seed))
+                 for size in args.sizes.split(',')]
+    reports = [_bench(name, page, args) for name, page in pages]
+    if args.json:
+        print(json.dumps(reports))
+        return
+    for report in reports:
+        print(f"{report['page']}: {report['bytes']} bytes, "
+              f"{report['speedup']}x faster, "
+              f"same text: {report['same_text']}, "
+              f"same tags: {report['same_tags']}")
+        for filter_name in _FILTERS:
+            print(f"  {filter_name}: {report[filter_name]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the link-removing page filter"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        help="Sizes of the synthetic pages, e.g. 50k,500k,5m",
+        default="50k,500k,5m"
+    )
+    parser.add_argument(
+        "--page",
+        type=str,
+        action="append",
+        default=[],
+        help="Saved HTML page to use instead of the synthetic ones; "
+             "may be given several times"
+    )
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        help="Piece size the streaming filter is fed with, bytes",
+        default=64 * 1024
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="Runs per filter and page, the best one counts",
+        default=3
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed of the synthetic pages",
+        default=1
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the report as JSON"
+    )
+    _main(parser.parse_args())
@@ -0,0 +1,64 @@
+import random
+
+_WORDS = ("proxy page link filter header footer news weather market "
+          "article comment author update story photo video share "
+          "город новости погода").split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def make_page(size: int, seed: int = 1) -> bytes:
+    # A synthetic news-portal page of about size bytes: inline styles
+    # and scripts in the head, a navigation menu, then articles mixing
+    # paragraphs, inline links, unclosed links, images, comments, and
+    # scripts and attribute values with markup in them, the way real
+    # pages do
+    rng = random.Random(seed)
+    head = ['<!DOCTYPE html>\n<html lang="ru"><head><meta charset="utf-8">',
+            f'<title>{_text(rng, 6)}</title>',
+            '<style>a { color: #06c } .nav a:hover { color: red }</style>',
+            '<script>var tpl = "<a href=\\"/x\\">x</a>";</script>',
+            '</head><body><div class="nav"><ul>']
+    head += [f'<li><a href="/section/{i}" class="nav-link">'
+             f'{_text(rng, 2)}</a></li>' for i in range(40)]
+    head.append('</ul></div><main>')
+    tail = '</main><footer>&copy; bench</footer></body></html>\n'
+    parts = head
+    length = sum(len(part.encode()) for part in parts) + len(tail)
+    article = 0
+    while length < size:
+        article += 1
+        block = [f'<article id="a{article}"><h2><a href="/story/{article}">'
+                 f'{_text(rng, 5)}</a></h2>']
+        for _ in range(rng.randint(2, 5)):
+            block.append(
+                f'<p>{_text(rng, rng.randint(20, 60))} '
+                f'<a href="/tag/{rng.randint(1, 500)}" title="{_text(rng, 2)}">'
+                f'{_text(rng, 2)}</a> {_text(rng, rng.randint(10, 30))}</p>')
+        block.append(f'<img src="/img/{article}.jpg" alt="{_text(rng, 3)}">')
+        if article % 3 == 0:
+            # Markup in attribute values is not a tag
+            block.append(f'<img src="/img/{article}-tag.png" '
+                         f'alt="see <a> tag"><button data-content="'
+                         f"<a href='/more/{article}'>more</a>\">"
+                         f'{_text(rng, 2)}</button>')
+        if article % 4 == 0:
+            # Unclosed links: one ends with its paragraph, one holds a
+            # second link that does not end it
+            block.append(f'<p>{_text(rng, 5)} <a href="/more/{article}">'
+                         f'{_text(rng, 2)}</p><p><a href="/a/{article}">'
+                         f'{_text(rng, 2)}<a href="/b/{article}">'
+                         f'{_text(rng, 2)}</a> {_text(rng, 3)}</p>')
+        if article % 5 == 0:
+            block.append(f'<!-- ad slot {article} <a href="/ad">ad</a> -->')
+        if article % 7 == 0:
+            block.append('<script>document.write("<a href=\'/promo\'>'
+                         'promo</a>");</script>')
+        block.append('</article>\n')
+        chunk = ''.join(block)
+        parts.append(chunk)
+        length += len(chunk.encode())
+    parts.append(tail)
+    return ''.join(parts).encode()
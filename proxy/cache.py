@@ -0,0 +1,382 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
+from time import time
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+# Bodies above this are passed through without being kept
+DEFAULT_MAX_OBJECT = 8 * 1024 * 1024
+# Statuses a cache may store without explicit freshness (RFC 9110,
+# 15.1)
+_CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414,
+                       501}
+# A 304 only refreshes a stored response and a 206 is part of one,
+# neither can stand in for a full response
+_UNSTORABLE_STATUSES = {206, 304}
+# Heuristic freshness: a tenth of the time since Last-Modified, at
+# most a day (RFC 9111, 4.2.2)
+_HEURISTIC_FRACTION = 0.1
+_HEURISTIC_MAX = 24 * 3600
+# Rough per-entry cost of the headers and bookkeeping
+_ENTRY_OVERHEAD = 500
+_DISK_SUFFIX = '.cache'
+
+_Key = tuple[str, str, tuple[tuple[str, str], ...]]
+
+
+def _directives(value: str | None) -> dict[str, str | None]:
+    # Cache-Control: "no-cache, max-age=60" -> {'no-cache': None,
+    # 'max-age': '60'}
+    directives = {}
+    for item in (value or '').split(','):
+        name, _, argument = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _seconds(value: str | None) -> int | None:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value: str | None) -> float | None:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class _Headers:
+    # Case-insensitive view of a header list
+    def __init__(self, headers):
+        self._items = list(headers.items()) if hasattr(headers, 'items') \
+            else list(headers)
+
+    def get(self, name: str) -> str | None:
+        name = name.lower()
+        values = [val for key, val in self._items if key.lower() == name]
+        return ', '.join(values) if values else None
+
+    def items(self) -> list[tuple[str, str]]:
+        return self._items
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    variant: str
+    # Request headers named by Vary, with the values they had
+    vary: tuple[tuple[str, str], ...]
+    status: int
+    headers: list[tuple[str, str]]
+    body: bytes
+    # Local time the response arrived, its Date and Age, and how long
+    # it stays fresh from Date
+    stored: float
+    date: float
+    age: float
+    lifetime: float
+
+    @property
+    def key(self) -> _Key:
+        return self.url, self.variant, self.vary
+
+    def header(self, name: str) -> str | None:
+        return _Headers(self.headers).get(name)
+
+    def current_age(self, now: float) -> float:
+        # RFC 9111, 4.2.3, without the request delay
+        return max(self.stored - self.date, self.age, 0) + now - self.stored
+
+    def is_fresh(self, now: float) -> bool:
+        if 'no-cache' in _directives(self.header('Cache-Control')):
+            return False
+        return self.lifetime > self.current_age(now)
+
+    def validators(self) -> dict[str, str]:
+        # Headers that turn a request into a revalidation
+        conditions = {}
+        if (etag := self.header('ETag')) is not None:
+            conditions['If-None-Match'] = etag
+        if (modified := self.header('Last-Modified')) is not None:
+            conditions['If-Modified-Since'] = modified
+        return conditions
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + _ENTRY_OVERHEAD
+
+
+class HTTPCache:
+    # A shared cache in the spirit of RFC 9111: responses are fresh for
+    # s-maxage, max-age, Expires or a Last-Modified heuristic; stale
+    # ones are revalidated with their ETag or Last-Modified; Vary picks
+    # the variant. Hot responses live in memory, and with a directory
+    # every response is also written to disk, so responses evicted from
+    # memory are still served from disk and the cache survives
+    # restarts. Both tiers evict least recently used responses past
+    # their byte budget. Stored entries are never changed in place,
+    # handler threads may be sending them.
+    def __init__(self, directory: str | None = None,
+                 memory_bytes: int = DEFAULT_MEMORY_BYTES,
+                 disk_bytes: int = DEFAULT_DISK_BYTES,
+                 max_object: int = DEFAULT_MAX_OBJECT):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.max_object = max_object
+        self._memory_bytes = memory_bytes
+        self._disk_bytes = disk_bytes
+        self._memory: OrderedDict[_Key, CachedResponse] = OrderedDict()
+        self._memory_size = 0
+        # Sizes of the responses on disk, least recently used first
+        self._disk: OrderedDict[_Key, int] = OrderedDict()
+        self._disk_size = 0
+        # Vary header names of the last response stored for a URL
+        self._vary: dict[tuple[str, str], tuple[str, ...]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    def lookup(self, url: str, variant: str,
+               request_headers: dict[str, str]) -> CachedResponse | None:
+        # The stored response for this request, fresh or not
+        with self.lock:
+            names = self._vary.get((url, variant))
+            entry = None
+            if names is not None:
+                key = (url, variant, _vary_values(names, request_headers))
+                entry = self._memory.get(key)
+                if entry is not None:
+                    self._memory.move_to_end(key)
+                elif key in self._disk:
+                    entry = self._read(key)
+                    if entry is not None:
+                        self._remember(entry)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+            if entry is None:
+                self.misses += 1
+            return entry
+
+    def usable(self, entry: CachedResponse,
+               request_headers: dict[str, str]) -> bool:
+        # Whether entry may be served without asking the origin
+        request = _Headers(request_headers)
+        directives = _directives(request.get('Cache-Control'))
+        now = time()
+        if ('no-cache' in directives
+                or 'no-cache' in (request.get('Pragma') or '')):
+            return False
+        max_age = _seconds(directives.get('max-age'))
+        if max_age is not None and entry.current_age(now) > max_age:
+            return False
+        if entry.is_fresh(now):
+            with self.lock:
+                self.hits += 1
+            return True
+        return False
+
+    def storable(self, request_headers: dict[str, str], status: int,
+                 response_headers) -> bool:
+        if status in _UNSTORABLE_STATUSES:
+            return False
+        request = _Headers(request_headers)
+        response = _Headers(response_headers)
+        requested = _directives(request.get('Cache-Control'))
+        directives = _directives(response.get('Cache-Control'))
+        if ('no-store' in requested or 'no-store' in directives
+                or 'private' in directives
+                or response.get('Set-Cookie') is not None
+                or response.get('Vary') == '*'):
+            return False
+        explicit = ('max-age' in directives or 's-maxage' in directives
+                    or response.get('Expires') is not None)
+        if status not in _CACHEABLE_STATUSES and not explicit:
+            return False
+        if (request.get('Authorization') is not None
+                and not {'public', 's-maxage',
+                         'must-revalidate'} & directives.keys()):
+            return False
+        return (explicit or response.get('ETag') is not None
+                or response.get('Last-Modified') is not None)
+
+    def store(self, url: str, variant: str,
+              request_headers: dict[str, str], status: int,
+              headers: list[tuple[str, str]], body: bytes,
+              received: float) -> CachedResponse | None:
+        if len(body) > self.max_object:
+            return None
+        vary = _vary_names(_Headers(headers).get('Vary'))
+        entry = CachedResponse(url, variant,
+                               _vary_values(vary, request_headers),
+                               status, headers, body, received, 0, 0, 0)
+        _update_freshness(entry, received)
+        if self.directory is not None:
+            self._write(entry)
+        with self.lock:
+            self._vary[(url, variant)] = vary
+            self._remember(entry)
+            if self.directory is not None:
+                self._disk_put(entry.key, entry.size)
+        return entry
+
+    def revalidated(self, entry: CachedResponse, response_headers,
+                    received: float) -> CachedResponse:
+        # A 304 refreshes the stored headers and the freshness. The
+        # refreshed response is a new entry that replaces entry.
+        fresh = _Headers(response_headers)
+        names = {key.lower() for key, _ in fresh.items()} - {
+            'content-length', 'content-encoding', 'transfer-encoding'}
+        revised = replace(
+            entry, stored=received,
+            headers=[(key, val) for key, val in entry.headers
+                     if key.lower() not in names] + [
+                (key, val) for key, val in fresh.items()
+                if key.lower() in names])
+        _update_freshness(revised, received)
+        if self.directory is not None:
+            self._write(revised)
+        with self.lock:
+            self.revalidations += 1
+            if self._memory.get(revised.key) is entry:
+                self._remember(revised)
+        return revised
+
+    def _remember(self, entry: CachedResponse):
+        key = entry.key
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= old.size
+        if entry.size > self._memory_bytes:
+            return
+        self._memory[key] = entry
+        self._memory_size += entry.size
+        while self._memory_size > self._memory_bytes:
+            # On disk the evicted response is still there
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= evicted.size
+            if self.directory is None:
+                self.evictions += 1
+
+    def _disk_put(self, key: _Key, size: int):
+        self._disk_size += size - self._disk.pop(key, 0)
+        self._disk[key] = size
+        while self._disk_size > self._disk_bytes and len(self._disk) > 1:
+            evicted, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            self.evictions += 1
+            self._memory_size -= getattr(
+                self._memory.pop(evicted, None), 'size', 0)
+            try:
+                os.remove(self._path(evicted))
+            except OSError:
+                pass
+
+    # On disk a response is one file: a line of JSON with everything
+    # but the body, then the body.
+
+    def _path(self, key: _Key) -> str:
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + _DISK_SUFFIX)
+
+    def _write(self, entry: CachedResponse):
+        path = self._path(entry.key)
+        meta = {'url': entry.url, 'variant': entry.variant,
+                'vary': entry.vary, 'status': entry.status,
+                'headers': entry.headers, 'stored': entry.stored,
+                'date': entry.date, 'age': entry.age,
+                'lifetime': entry.lifetime}
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(json.dumps(meta).encode() + b'\n')
+                f.write(entry.body)
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f"Cache write error: {e}")
+
+    def _read(self, key: _Key) -> CachedResponse | None:
+        try:
+            with open(self._path(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError) as e:
+            print(f"Cache read error: {e}")
+            self._disk_size -= self._disk.pop(key, 0)
+            return None
+        return CachedResponse(
+            meta['url'], meta['variant'],
+            tuple(tuple(pair) for pair in meta['vary']), meta['status'],
+            [tuple(pair) for pair in meta['headers']], body,
+            meta['stored'], meta['date'], meta['age'], meta['lifetime'])
+
+    def _load_index(self):
+        # Rebuilds the disk index, oldest files first as the least
+        # recently used
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            if not name.endswith(_DISK_SUFFIX):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    meta = json.loads(f.readline())
+                stat = os.stat(path)
+            except (OSError, ValueError):
+                continue
+            files.append((stat.st_mtime, meta, stat.st_size))
+        for _, meta, size in sorted(files, key=lambda item: item[0]):
+            vary = tuple(tuple(pair) for pair in meta['vary'])
+            self._vary[(meta['url'], meta['variant'])] = tuple(
+                name for name, _ in vary)
+            self._disk_put((meta['url'], meta['variant'], vary), size)
+
+
+def _vary_names(value: str | None) -> tuple[str, ...]:
+    return tuple(sorted({name.strip().lower()
+                         for name in (value or '').split(',')
+                         if name.strip()}))
+
+
+def _vary_values(names: tuple[str, ...],
+                 request_headers: dict[str, str]
+                 ) -> tuple[tuple[str, str], ...]:
+    request = _Headers(request_headers)
+    return tuple((name, request.get(name) or '') for name in names)
+
+
+def _update_freshness(entry: CachedResponse, received: float):
+    # RFC 9111, 4.2.1: s-maxage, then max-age, then Expires, then the
+    # Last-Modified heuristic for statuses cacheable by default
+    directives = _directives(entry.header('Cache-Control'))
+    entry.date = _http_date(entry.header('Date')) or received
+    entry.age = _seconds(entry.header('Age')) or 0
+    lifetime = _seconds(directives.get('s-maxage'))
+    if lifetime is None:
+        lifetime = _seconds(directives.get('max-age'))
+    if lifetime is None and (expires := entry.header('Expires')):
+        lifetime = max((_http_date(expires) or 0) - entry.date, 0)
+    if lifetime is None:
+        modified = _http_date(entry.header('Last-Modified'))
+        lifetime = 0
+        if modified is not None and entry.status in _CACHEABLE_STATUSES:
+            lifetime = min((entry.date - modified) * _HEURISTIC_FRACTION,
+                           _HEURISTIC_MAX)
+    entry.lifetime = max(lifetime, 0)
@@ -1,14 +1,68 @@
+import zlib
 from http.server import BaseHTTPRequestHandler
-import requests
+from time import time
 from urllib.parse import urlparse
 
+from proxy.cache import CachedResponse, HTTPCache
 from proxy.parser import LinkRemoverPageParser
+from proxy.pool import ConnectionPool, PooledResponse
 
+# Headers that describe one connection rather than the message
+# (RFC 9110, 7.6.1), not forwarded in either direction
+_HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection',
+               'proxy-authenticate', 'proxy-authorization', 'te',
+               'trailer', 'transfer-encoding', 'upgrade'}
+# How long an idle client connection is kept open
+_CLIENT_TIMEOUT = 60
+# Largest piece of a passed-through body held at a time
+_CHUNK_SIZE = 64 * 1024
+# Requests the client makes conditional or partial itself go straight
+# to the origin, and their responses are not stored
+_UNCACHED_REQUEST = {'if-none-match', 'if-modified-since', 'if-match',
+                     'if-unmodified-since', 'if-range', 'range'}
+# Response headers that are not kept with a cached body
+_UNCACHED_HEADERS = {'content-length', 'age'}
+# Content codings the filter can undo, as zlib window bits; an origin
+# may compress a page even when asked for identity
+_DECODABLE = {'gzip': 16 + zlib.MAX_WBITS, 'x-gzip': 16 + zlib.MAX_WBITS,
+              'deflate': zlib.MAX_WBITS}
 
-def make_filtering_handler(domains: list[str]) -> BaseHTTPRequestHandler:
+
+def _forwarded(headers) -> dict[str, str]:
+    # Connection may name further per-connection headers
+    hop_by_hop = _HOP_BY_HOP | {
+        name.strip().lower()
+        for value in headers.get_all('Connection', [])
+        for name in value.split(',')}
+    return {key: val for key, val in headers.items()
+            if key.lower() not in hop_by_hop}
+
+
+def _body(resp: PooledResponse, parser: LinkRemoverPageParser | None,
+          decoder=None):
+    while data := resp.read1(_CHUNK_SIZE):
+        if decoder is not None:
+            data = decoder.decompress(data)
+        if parser is not None:
+            data = parser.feed(data)
+        if data:
+            yield data
+    tail = decoder.flush() if decoder is not None else b''
+    if parser is not None:
+        tail = parser.feed(tail) + parser.close()
+    if tail:
+        yield tail
+
+
+def make_filtering_handler(domains: list[str], pool: ConnectionPool,
+                           cache: HTTPCache) -> BaseHTTPRequestHandler:
     filter_domains = domains.copy()
 
     class FilteringProxyRequestHandler(BaseHTTPRequestHandler):
+        # Keep-alive towards clients; every response carries its length
+        protocol_version = 'HTTP/1.1'
+        timeout = _CLIENT_TIMEOUT
+
         def do_GET(self):
             parsed_url = urlparse(self.path)
 
@@ -17,31 +71,144 @@ def make_filtering_handler(domains: list[str]) -> BaseHTTPRequestHandler:
                 return
 
             target_url = self.path
+            self._head_sent = False
             domain = parsed_url.hostname
+            filtering = self._needs_filtering(domain)
+
+            # Filtered pages are cached filtered, so the filter runs
+            # once per version of a page
+            variant = 'filtered' if filtering else ''
 
             try:
-                headers = {key: val for key, val in self.headers.items()}
+                headers = _forwarded(self.headers)
+                if filtering:
+                    # The filter needs the page as text, not compressed
+                    headers = {key: val for key, val in headers.items()
+                               if key.lower() != 'accept-encoding'}
+                    headers['Accept-Encoding'] = 'identity'
 
-                resp = requests.get(target_url, headers=headers)
-                content = resp.content
+                cached = resp = None
+                bypass = bool(_UNCACHED_REQUEST
+                              & {key.lower() for key in headers})
+                if not bypass:
+                    cached = cache.lookup(target_url, variant, headers)
+                if cached is None or not cache.usable(cached, headers):
+                    if cached is not None:
+                        headers.update(cached.validators())
+                    resp = pool.request('GET', target_url, headers)
+                    received = time()
+                    if cached is not None and resp.status == 304:
+                        resp.read()
+                        cached = cache.revalidated(cached, resp.headers,
+                                                   received)
+            except Exception as e:
+                self.send_error(500, f"Error: {e}")
+                return
+            if resp is None or cached is not None and resp.status == 304:
+                self._send_cached(cached)
+                return
+
+            try:
+                record = None
+                if not bypass and cache.storable(headers, resp.status,
+                                                 resp.headers):
+                    record = []
                 content_type = resp.headers.get('Content-Type', '')
+                encoding = resp.headers.get('Content-Encoding',
+                                            'identity').strip().lower()
+                dropped = _UNCACHED_HEADERS
+                if (filtering and 'text/html' in content_type
+                        and (encoding == 'identity'
+                             or encoding in _DECODABLE)):
+                    decoder = None
+                    if encoding in _DECODABLE:
+                        # The page is sent on decoded
+                        decoder = zlib.decompressobj(_DECODABLE[encoding])
+                        dropped = _UNCACHED_HEADERS | {'content-encoding'}
+                    record = self._stream(resp, LinkRemoverPageParser(),
+                                          record, decoder)
+                else:
+                    # Codings zlib cannot undo are passed on unfiltered
+                    record = self._stream(resp, None, record)
+                if record is not None:
+                    cache.store(target_url, variant, headers, resp.status,
+                                [(key, val) for key, val
+                                 in _forwarded(resp.headers).items()
+                                 if key.lower() not in dropped],
+                                b''.join(record), received)
+            except Exception as e:
+                if self._head_sent:
+                    # Too late for an error page, only the connection
+                    # can tell the client the body is cut short
+                    self.close_connection = True
+                else:
+                    self.send_error(500, f"Error: {e}")
+            finally:
+                resp.close()
 
-                if self._needs_filtering(
-                        domain) and 'text/html' in content_type:
-                    parser = LinkRemoverPageParser()
-                    content = parser.parse(content)
+        def _stream(self, resp: PooledResponse,
+                    parser: LinkRemoverPageParser | None = None,
+                    record: list[bytes] | None = None,
+                    decoder=None) -> list[bytes] | None:
+            # Passes the body on as it arrives, a chunk at a time,
+            # decoded by decoder and through the parser if there are
+            # any. What is sent is also collected in record for the
+            # cache, unless it grows too large; returns record or None.
+            length = resp.headers.get('Content-Length')
+            skip = {'content-encoding'} if decoder is not None else set()
+            if resp.status in (204, 304) or resp.status < 200:
+                self._send_head(resp, {})
+                return record
+            if length is not None and parser is None:
+                self._send_head(resp, {'Content-Length': length})
+                write = self.wfile.write
+            elif self.request_version == 'HTTP/1.1':
+                self._send_head(resp, {'Transfer-Encoding': 'chunked'},
+                                skip)
+                write = self._write_chunk
+            else:
+                # An HTTP/1.0 client only learns where the body ends
+                # from the connection closing
+                self.close_connection = True
+                self._send_head(resp, {'Connection': 'close'}, skip)
+                write = self.wfile.write
+            recorded = 0
+            for data in _body(resp, parser, decoder):
+                write(data)
+                if record is not None:
+                    recorded += len(data)
+                    if recorded > cache.max_object:
+                        record = None
+                    else:
+                        record.append(data)
+            if write == self._write_chunk:
+                self.wfile.write(b'0\r\n\r\n')
+            return record
 
-                self.send_response(resp.status_code)
-                for key, val in resp.headers.items():
-                    if key.lower() in ['content-encoding', 'content-length']:
-                        continue
-                    self.send_header(key, val)
-                self.send_header('Content-Length', str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
+        def _send_cached(self, entry: CachedResponse):
+            self.send_response(entry.status)
+            for key, val in entry.headers:
+                self.send_header(key, val)
+            self.send_header('Age', str(int(entry.current_age(time()))))
+            if entry.status != 204:
+                self.send_header('Content-Length', str(len(entry.body)))
+            self.end_headers()
+            self.wfile.write(entry.body)
 
-            except Exception as e:
-                self.send_error(500, f"Error: {e}")
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+        def _send_head(self, resp: PooledResponse, framing: dict,
+                       skip: set[str] = frozenset()):
+            self.send_response(resp.status)
+            for key, val in _forwarded(resp.headers).items():
+                if key.lower() == 'content-length' or key.lower() in skip:
+                    continue
+                self.send_header(key, val)
+            for key, val in framing.items():
+                self.send_header(key, str(val))
+            self.end_headers()
+            self._head_sent = True
 
         def _needs_filtering(self, domain: str) -> bool:
             return any(domain.endswith(d) for d in filter_domains)
@@ -1,13 +1,156 @@
-from bs4 import BeautifulSoup
+import re
+
+# Start of a comment, a tag with its name, or a declaration such as
+# <!DOCTYPE>. A "<" followed by anything else is text.
+_MARKUP = re.compile(rb'<(?:!--|(/?)([a-zA-Z][^\s/>]*)|[!?])')
+# Elements whose content is text, where "<a" is not a tag
+_RAW_TEXT = {b'script', b'style', b'textarea', b'title'}
+# Elements without content or end tag, never left open
+_VOID = {b'area', b'base', b'basefont', b'bgsound', b'br', b'col',
+         b'command', b'embed', b'frame', b'hr', b'image', b'img', b'input',
+         b'isindex', b'keygen', b'link', b'menuitem', b'meta', b'nextid',
+         b'param', b'source', b'spacer', b'track', b'wbr'}
+# A tag from "<" to the ">" that is not inside a quoted attribute value
+_TAG = re.compile(rb'<[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+# A "<" not closed by a ">" this far on is taken for text, so a broken
+# tag cannot make the filter hold the rest of the page
+_MAX_TAG = 64 * 1024
+
+_TEXT, _COMMENT, _RAW = range(3)
 
 
 class LinkRemoverPageParser:
-    def parse(self, content: str):
-        try:
-            soup = BeautifulSoup(content, "html.parser")
-            for a_tag in soup.find_all("a"):
-                a_tag.decompose()
-            return soup.encode()
-        except Exception as e:
-            print(f"HTML parsing error: {e}")
-            return content
\ No newline at end of file
+    # Removes <a> elements with everything inside them. Works on the
+    # raw bytes of any ASCII-compatible encoding as they arrive: feed()
+    # returns the output that is certain so far and only an unfinished
+    # tag is held back. Everything outside the removed elements is
+    # passed on byte for byte.
+    #
+    # Open elements are tracked the way a DOM builder does, so a link
+    # ends where its element does: at its own </a>, or at the end tag
+    # of an element around it when the link was left unclosed. An end
+    # tag nothing open matches is ignored, as is a nested <a>.
+    def __init__(self):
+        self._buffer = b''
+        self._state = _TEXT
+        self._end_tag: re.Pattern | None = None
+        # Names of the open elements, and how many of each are open
+        self._open: list[bytes] = []
+        self._counts: dict[bytes, int] = {}
+        # Where the <a> being removed is in _open, if one is
+        self._link: int | None = None
+
+    def parse(self, content: bytes) -> bytes:
+        return self.feed(content) + self.close()
+
+    def feed(self, data: bytes) -> bytes:
+        buffer = self._buffer + data
+        out = []
+        pos = 0
+        while pos < len(buffer):
+            if self._state == _COMMENT:
+                end = buffer.find(b'-->', pos)
+                if end < 0:
+                    # Keep what could be the start of "-->"
+                    keep = max(pos, len(buffer) - 2)
+                    self._emit(out, buffer[pos:keep])
+                    pos = keep
+                    break
+                self._emit(out, buffer[pos:end + 3])
+                pos = end + 3
+                self._state = _TEXT
+            elif self._state == _RAW:
+                match = self._end_tag.search(buffer, pos)
+                if match is None:
+                    keep = max(pos, len(buffer) - len(self._end_tag.pattern))
+                    self._emit(out, buffer[pos:keep])
+                    pos = keep
+                    break
+                self._emit(out, buffer[pos:match.start()])
+                pos = match.start()
+                self._state = _TEXT
+            else:
+                match = _MARKUP.search(buffer, pos)
+                if match is None:
+                    # Hold back a "<" or "</" that more input may
+                    # complete
+                    keep = buffer.rfind(b'<', max(pos, len(buffer) - 2))
+                    if keep < 0:
+                        keep = len(buffer)
+                    self._emit(out, buffer[pos:keep])
+                    pos = keep
+                    break
+                self._emit(out, buffer[pos:match.start()])
+                pos = match.start()
+                end = self._tag(out, buffer, match)
+                if end is None:
+                    break
+                pos = end
+        self._buffer = buffer[pos:]
+        return b''.join(out)
+
+    def close(self) -> bytes:
+        # An unfinished tag at the very end is passed on as it is
+        out = []
+        self._emit(out, self._buffer)
+        self._buffer = b''
+        return b''.join(out)
+
+    def _tag(self, out: list[bytes], buffer: bytes,
+             markup: re.Match) -> int | None:
+        # Handles the markup found, returns where to go on from or None
+        # when more input is needed to tell. Every tag is taken whole,
+        # so markup inside its quoted attribute values is left alone.
+        start = markup.start()
+        if markup.group() == b'<!--':
+            self._emit(out, b'<!--')
+            self._state = _COMMENT
+            return start + 4
+        match = _TAG.match(buffer, start)
+        if match is None:
+            if len(buffer) - start < _MAX_TAG:
+                return None
+            self._emit(out, b'<')
+            return start + 1
+        tag = match.group()
+        name = (markup.group(2) or b'').lower()
+        closing = bool(markup.group(1))
+        if closing:
+            self._close(out, tag, name)
+            return match.end()
+        if (name == b'a' and self._link is None
+                and not tag.endswith(b'/>')):
+            self._link = len(self._open)
+        self._emit(out, tag)
+        if name and name not in _VOID and not tag.endswith(b'/>'):
+            self._open.append(name)
+            self._counts[name] = self._counts.get(name, 0) + 1
+        if name in _RAW_TEXT:
+            self._state = _RAW
+            self._end_tag = re.compile(b'</' + name, re.IGNORECASE)
+        return match.end()
+
+    def _close(self, out: list[bytes], tag: bytes, name: bytes):
+        if not self._counts.get(name):
+            # Nothing open to close: passed on as it is, unless it is a
+            # stray </a>
+            if name != b'a':
+                self._emit(out, tag)
+            return
+        while True:
+            popped = self._open.pop()
+            self._counts[popped] -= 1
+            if popped == name:
+                break
+        if self._link is not None and len(self._open) <= self._link:
+            # The link's own end tag goes with it, an end tag of an
+            # element around an unclosed link stays
+            own = name == b'a' and len(self._open) == self._link
+            self._link = None
+            if own:
+                return
+        self._emit(out, tag)
+
+    def _emit(self, out: list[bytes], data: bytes):
+        if data and self._link is None:
+            out.append(data)
@@ -0,0 +1,173 @@
+import http.client
+import threading
+from time import monotonic
+from urllib.parse import urlsplit
+
+# Errors a reused connection gives when the origin has closed it
+# while it sat idle; the request is retried on a fresh one
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError,
+                 BrokenPipeError)
+
+_Key = tuple[str, str, int]
+
+
+class PooledResponse:
+    # An origin response that gives its connection back to the pool
+    # once the body has been read to the end
+    def __init__(self, pool: 'ConnectionPool', key: _Key,
+                 conn: http.client.HTTPConnection,
+                 response: http.client.HTTPResponse):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt: int | None = None) -> bytes:
+        try:
+            data = self.response.read(amt)
+        except BaseException:
+            self.close()
+            raise
+        if amt is None or not data:
+            self.release()
+        return data
+
+    def read1(self, amt: int) -> bytes:
+        # Up to amt bytes, without waiting for more than is at hand
+        try:
+            data = self.response.read1(amt)
+        except BaseException:
+            self.close()
+            raise
+        if not data:
+            self.release()
+        return data
+
+    def release(self):
+        # Only a fully read response leaves the connection in a state
+        # where the next request can go out on it
+        if self._conn is None:
+            return
+        # read1 leaves the response open after the last byte of a body
+        # of known length
+        done = self.response.isclosed() or self.response.length == 0
+        if done and not self.response.will_close:
+            self.response.close()
+            self._pool._put(self._key, self._conn)
+            self._conn = None
+        else:
+            self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool._discard(self._key, self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    # Keep-alive connections to origins shared by the handler threads.
+    # At most max_per_host connections to one origin exist at a time,
+    # further requests wait for one to come back; connections idle for
+    # longer than idle_timeout are closed.
+    def __init__(self, max_per_host: int = 8, idle_timeout: float = 60,
+                 timeout: float = 30):
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._lock = threading.Condition()
+        self._idle: dict[_Key, list[tuple[http.client.HTTPConnection,
+                                          float]]] = {}
+        self._open: dict[_Key, int] = {}
+
+        self.created = 0
+        self.reused = 0
+
+    def request(self, method: str, url: str, headers: dict[str, str],
+                body: bytes | None = None) -> PooledResponse:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported scheme: {parts.scheme}")
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = self._get(key)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except _STALE_ERRORS:
+                self._discard(key, conn)
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self._discard(key, conn)
+                raise
+            return PooledResponse(self, key, conn, response)
+
+    def close(self):
+        with self._lock:
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    conn.close()
+                self._open[key] -= len(idle)
+            self._idle.clear()
+            self._lock.notify_all()
+
+    def _get(self, key: _Key) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            self._evict()
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    # Most recently used first, the likeliest to be alive
+                    conn, _ = idle.pop()
+                    self.reused += 1
+                    return conn, True
+                if self._open.get(key, 0) < self._max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                self._lock.wait()
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self._timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self._timeout)
+        self.created += 1
+        return conn, False
+
+    def _put(self, key: _Key, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._evict()
+            self._idle.setdefault(key, []).append((conn, monotonic()))
+            self._lock.notify_all()
+
+    def _discard(self, key: _Key, conn: http.client.HTTPConnection):
+        conn.close()
+        with self._lock:
+            self._open[key] -= 1
+            self._lock.notify_all()
+
+    def _evict(self):
+        deadline = monotonic() - self._idle_timeout
+        for key in list(self._idle):
+            idle = self._idle[key]
+            # Oldest first, so the stale ones form a prefix
+            stale = 0
+            while stale < len(idle) and idle[stale][1] < deadline:
+                idle[stale][0].close()
+                stale += 1
+            if stale:
+                del idle[:stale]
+                self._open[key] -= stale
+                self._lock.notify_all()
+            if not idle:
+                del self._idle[key]
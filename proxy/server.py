@@ -1,13 +1,23 @@
 from socketserver import ThreadingTCPServer
 
+from proxy.cache import (DEFAULT_DISK_BYTES, DEFAULT_MEMORY_BYTES,
+                         HTTPCache)
 from proxy.handler import make_filtering_handler
+from proxy.pool import ConnectionPool
 
 
 class FilteringProxyServer:
-    def __init__(self, filter_domain: list[str], port: int = 8080):
+    def __init__(self, filter_domain: list[str], port: int = 8080,
+                 max_per_host: int = 8, idle_timeout: float = 60,
+                 cache_dir: str | None = None,
+                 cache_memory: int = DEFAULT_MEMORY_BYTES,
+                 cache_disk: int = DEFAULT_DISK_BYTES):
         self._port = port
         self._filter_domains = filter_domain.copy()
-        self._handler = make_filtering_handler(self._filter_domains)
+        self._pool = ConnectionPool(max_per_host, idle_timeout)
+        self._cache = HTTPCache(cache_dir, cache_memory, cache_disk)
+        self._handler = make_filtering_handler(self._filter_domains,
+                                               self._pool, self._cache)
         
     def start(self):
         try:
@@ -21,6 +31,10 @@ class FilteringProxyServer:
                 httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nShutting down proxy server.")
+        finally:
+            self._pool.close()
             
     class _ReusableTCPServer(ThreadingTCPServer):
-        allow_reuse_address = True
\ No newline at end of file
+        allow_reuse_address = True
+        # Kept-alive client connections must not hold up the shutdown
+        daemon_threads = True